@@ -23,23 +23,26 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
 import os
+import shutil
 import uuid
 import json
 import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from pathlib import Path
 from flask import Flask, request, jsonify, send_file, send_from_directory
 from flask_cors import CORS
 from werkzeug.utils import secure_filename
 import matchering as mg
-from matchering import Config, Result, pcm16, pcm24
+from matchering import Config, Result
 from matchering.defaults import LimiterConfig
-from matchering.loader import load as mg_load
-from matchering.checker import check as mg_check
+from matchering.loader import probe as mg_probe
+from matchering.log import ModuleError
 from matchering.saver import save as mg_save
-from matchering.dsp import size as dsp_size, strided_app_2d, batch_rms_2d, fade
-import soundfile as sf
-import numpy as np
+from matchering.dsp import size as dsp_size, fade
+from matchering.preview_creator import read_preview_piece
+from job_store import create_job_store, rank_masterings
 # MP3 conversion removed - using WAV only
 
 app = Flask(__name__, static_folder='.', static_url_path='')
@@ -60,6 +63,14 @@ PREVIEWS_FOLDER = Path('previews')
 MAX_REFERENCES = 10
 ALLOWED_EXTENSIONS = {'wav', 'mp3', 'flac', 'aiff', 'm4a', 'ogg'}
 DEFAULT_THRESHOLD = (2**15 - 61) / 2**15
+# Maximum number of masterings running at the same time across all jobs
+MAX_WORKERS = max(1, int(os.getenv('MATCHERING_WORKERS', os.cpu_count() or 1)))
+# Maximum number of masterings waiting for a worker before new uploads are rejected
+MAX_PENDING_MASTERINGS = max(1, int(os.getenv('MATCHERING_MAX_PENDING', MAX_WORKERS * MAX_REFERENCES)))
+# SQLite database shared by all server processes, or 'memory' to keep jobs in this process only
+JOB_STORE = os.getenv('MATCHERING_JOB_STORE', str(RESULTS_FOLDER / 'jobs.sqlite3'))
+# Master at the sample rate of the uploaded target instead of resampling it to 44100 Hz
+NATIVE_SAMPLE_RATE = os.getenv('MATCHERING_NATIVE_SAMPLE_RATE', 'True').lower() == 'true'
 
 LOUDNESS_PRESETS = {
     'low': {
@@ -113,101 +124,78 @@ LIMITER_FIELD_NAMES = {
 }
 
 
-def apply_post_limiter_normalization(file_paths, ceiling):
-    """Normalize rendered files to a target ceiling after limiting."""
-    if not isinstance(file_paths, (list, tuple)):
-        file_paths = [file_paths]
-    for file_path in file_paths:
-        if not file_path:
-            continue
-        file_path = Path(file_path)
-        if not file_path.exists():
-            continue
-        try:
-            info = sf.info(str(file_path))
-            audio, sample_rate = sf.read(str(file_path), dtype='float32')
-        except Exception as exc:
-            print(f"Failed to read {file_path} for normalization: {exc}")
-            continue
-        peak = float(np.max(np.abs(audio)))
-        if peak <= 0 or np.isclose(peak, 0):
-            continue
-        if np.isclose(peak, ceiling):
-            continue
-        gain = ceiling / peak
-        audio *= gain
-        try:
-            sf.write(str(file_path), audio, sample_rate, subtype=info.subtype)
-            print(f"Applied {20 * np.log10(gain):.2f} dB make-up gain to {file_path.name}")
-        except Exception as exc:
-            print(f"Failed to write normalized file {file_path}: {exc}")
+def get_post_limiter_ceiling(limiter_settings):
+    """Return the post-limiter normalization ceiling of the settings, or None if it is off."""
+    ceiling = limiter_settings.get('post_normalize_ceiling')
+    if limiter_settings.get('post_normalize') and ceiling:
+        return ceiling
+    return None
 
 # Ensure directories exist
 UPLOAD_FOLDER.mkdir(exist_ok=True)
 RESULTS_FOLDER.mkdir(exist_ok=True)
 PREVIEWS_FOLDER.mkdir(exist_ok=True)
 
-# In-memory storage for voting data
-voting_data = {}
-processing_jobs = {}
-
-def generate_variant_previews(target_path, variant_audio_paths, preview_output_paths, config, temp_folder):
-    """Generate aligned previews for each mastering variant."""
-    try:
-        target_array, target_sr = mg_load(str(target_path), "target", temp_folder)
-        target_array, _ = mg_check(target_array, target_sr, config, "target")
-    except Exception as exc:
-        print(f"Failed to load target for previews: {exc}")
-        return {}
-    
-    variant_arrays = {}
-    for key, audio_path in variant_audio_paths.items():
-        if not audio_path:
-            continue
+# Storage for processing jobs and voting data
+job_store = create_job_store(JOB_STORE)
+# Guards pending_masterings against the worker pool callbacks
+pending_lock = threading.Lock()
+pending_masterings = 0
+
+worker_pool = None
+worker_pool_lock = threading.Lock()
+
+def get_worker_pool():
+    """Create the shared mastering process pool on first use."""
+    global worker_pool
+    with worker_pool_lock:
+        if worker_pool is None:
+            # Every worker masters one reference at a time, so keep the numeric libraries
+            # of the workers single-threaded instead of oversubscribing the cores
+            for variable in ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS'):
+                os.environ.setdefault(variable, '1')
+            # Spawned workers do not inherit the threads of the Flask server
+            worker_pool = ProcessPoolExecutor(
+                max_workers=MAX_WORKERS,
+                mp_context=multiprocessing.get_context('spawn'),
+            )
+        return worker_pool
+
+def generate_variant_previews(target_path, variant_audio_paths, preview_output_paths, config,
+                              preview_window, sample_rate):
+    """Cut aligned previews of the target and every mastering variant.
+
+    Only the loudest window found by Matchering is read from each file, so the
+    rendered variants are never decoded in full.
+    """
+    fade_size = round(config.preview_fade_size / config.internal_sample_rate * sample_rate)
+    
+    def save_piece(key, audio_path, name):
+        preview_path = preview_output_paths.get(key)
+        if not audio_path or not preview_path:
+            return
         try:
-            audio_array, audio_sr = mg_load(str(audio_path), "reference", temp_folder)
-            audio_array, _ = mg_check(audio_array, audio_sr, config, "reference")
-            variant_arrays[key] = audio_array
+            # Targets that only ffmpeg can decode are decoded in full
+            piece = read_preview_piece(
+                str(audio_path), preview_window, sample_rate, config.resampling_quality,
+                file_type="target" if key == 'original' else "result",
+            )
         except Exception as exc:
-            print(f"Failed to load {key} result for previews: {exc}")
-    
-    if not variant_arrays:
-        return {}
-    
-    base_key = 'limited' if 'limited' in variant_arrays else next(iter(variant_arrays))
-    preview_size = int(config.preview_size)
-    analysis_step = int(config.preview_analysis_step)
-    
-    target_pieces = strided_app_2d(target_array, preview_size, analysis_step)
-    variant_pieces = {key: strided_app_2d(arr, preview_size, analysis_step) for key, arr in variant_arrays.items()}
-    base_pieces = variant_pieces[base_key]
-    
-    loudest_idx = int(np.argmax(batch_rms_2d(base_pieces)))
-    loudest_idx = min(loudest_idx, base_pieces.shape[0] - 1)
-    
-    def extract_piece(pieces):
-        idx = min(loudest_idx, pieces.shape[0] - 1)
-        piece = pieces[idx].copy()
-        fade_base = dsp_size(piece) // max(1, config.preview_fade_coefficient)
-        fade_len = min(int(config.preview_fade_size), int(fade_base))
+            print(f"Failed to read the {key} preview: {exc}")
+            return
+        if dsp_size(piece) == 0:
+            print(f"The {key} audio is too short for the preview")
+            return
+        fade_len = min(fade_size, dsp_size(piece) // max(1, config.preview_fade_coefficient))
         if fade_len > 0:
             piece = fade(piece, fade_len)
-        return piece
+        mg_save(str(preview_path), piece, sample_rate, "PCM_16", name)
+        preview_map[key] = str(preview_path)
     
     preview_map = {}
-    
-    if 'original' in preview_output_paths:
-        target_piece = extract_piece(target_pieces)
-        mg_save(str(preview_output_paths['original']), target_piece, config.internal_sample_rate, "PCM_16", "target preview")
-        preview_map['original'] = str(preview_output_paths['original'])
-    
-    for key, pieces in variant_pieces.items():
-        preview_path = preview_output_paths.get(key)
-        if not preview_path:
-            continue
-        variant_piece = extract_piece(pieces)
-        mg_save(str(preview_path), variant_piece, config.internal_sample_rate, "PCM_16", f"{key} preview")
-        preview_map[key] = str(preview_path)
+    save_piece('original', target_path, "target preview")
+    for key, audio_path in variant_audio_paths.items():
+        save_piece(key, audio_path, f"{key} preview")
     
     return preview_map
 
@@ -248,20 +236,23 @@ def parse_limiter_settings(form_data):
         settings[limiter_key] = numeric_value
     return settings
 
-def build_config(limiter_settings=None):
-    """Create a Matchering config, optionally overriding limiter values."""
-    if not limiter_settings:
-        return Config()
+def build_limiter_config(limiter_settings=None):
+    """Create a limiter config from the limiter values of the settings."""
     limiter_kwargs = {
         key: value
-        for key, value in limiter_settings.items()
+        for key, value in (limiter_settings or {}).items()
         if key in LIMITER_FIELD_NAMES
     }
-    config_kwargs = {}
+    return LimiterConfig(**limiter_kwargs) if limiter_kwargs else LimiterConfig()
+
+def build_config(limiter_settings=None):
+    """Create a Matchering config, optionally overriding limiter values."""
+    if not limiter_settings:
+        return Config(native_sample_rate=NATIVE_SAMPLE_RATE)
+    config_kwargs = {'native_sample_rate': NATIVE_SAMPLE_RATE}
     if 'threshold' in limiter_settings:
         config_kwargs['threshold'] = limiter_settings['threshold']
-    limiter = LimiterConfig(**limiter_kwargs) if limiter_kwargs else LimiterConfig()
-    return Config(limiter=limiter, **config_kwargs)
+    return Config(limiter=build_limiter_config(limiter_settings), **config_kwargs)
 
 def resolve_limiter_settings(variant, user_settings=None):
     base = dict(LOUDNESS_PRESETS.get(variant, LOUDNESS_PRESETS['medium']))
@@ -307,45 +298,44 @@ def process_mastering(target_path, reference_path, job_id, reference_index, limi
             'nolimiter_normalized': None,
         }
         
+        # All presets are rendered by a single process() call: the matching is shared
+        # unless the threshold of low or high also changes the normalization of the reference
+        # The post-limiter normalization of every preset is applied in memory before saving
+        medium_settings = resolve_limiter_settings('medium', limiter_settings)
+        medium_ceiling = get_post_limiter_ceiling(medium_settings)
+        config = build_config(medium_settings)
+        variant_results = {}
         for variant in LOUDNESS_VARIANTS:
-            variant_settings = resolve_limiter_settings(variant, limiter_settings)
-            config = build_config(variant_settings)
-            post_norm_ceiling = variant_settings.get('post_normalize_ceiling')
-            apply_post_norm = variant_settings.get('post_normalize') and post_norm_ceiling
-            
             if variant == 'medium':
-                mg.process(
-                    target=str(target_path),
-                    reference=str(reference_path),
-                    results=[
-                        pcm16(str(wav_16bit_medium)),
-                        pcm24(str(wav_24bit_medium)),
-                        Result(str(wav_24bit_no_limiter), subtype="PCM_24", use_limiter=False, normalize=False),
-                        Result(str(wav_24bit_no_limiter_normalized), subtype="PCM_24", use_limiter=False, normalize=True),
-                    ],
-                    config=config,
-                )
-                if apply_post_norm:
-                    apply_post_limiter_normalization(
-                        [wav_16bit_medium, wav_24bit_medium],
-                        post_norm_ceiling,
-                    )
-                variant_audio_paths['limited'] = wav_24bit_medium
-                variant_audio_paths['nolimiter'] = wav_24bit_no_limiter
-                variant_audio_paths['nolimiter_normalized'] = wav_24bit_no_limiter_normalized
-            else:
-                variant_path = wav_24bit_low if variant == 'low' else wav_24bit_high
-                mg.process(
-                    target=str(target_path),
-                    reference=str(reference_path),
-                    results=[
-                        pcm24(str(variant_path)),
-                    ],
-                    config=config,
-                )
-                if apply_post_norm:
-                    apply_post_limiter_normalization(variant_path, post_norm_ceiling)
-                variant_audio_paths[variant] = variant_path
+                continue
+            variant_settings = resolve_limiter_settings(variant, limiter_settings)
+            variant_path = wav_24bit_low if variant == 'low' else wav_24bit_high
+            variant_results[variant] = Result(
+                str(variant_path),
+                subtype="PCM_24",
+                limiter=build_limiter_config(variant_settings),
+                threshold=variant_settings.get('threshold'),
+                ceiling=get_post_limiter_ceiling(variant_settings),
+            )
+        
+        preview_window, sample_rate = mg.process(
+            target=str(target_path),
+            reference=str(reference_path),
+            results=[
+                Result(str(wav_16bit_medium), subtype="PCM_16", ceiling=medium_ceiling),
+                Result(str(wav_24bit_medium), subtype="PCM_24", ceiling=medium_ceiling),
+                Result(str(wav_24bit_no_limiter), subtype="PCM_24", use_limiter=False, normalize=False),
+                Result(str(wav_24bit_no_limiter_normalized), subtype="PCM_24", use_limiter=False, normalize=True),
+                *variant_results.values(),
+            ],
+            config=config,
+        )
+        
+        variant_audio_paths['limited'] = wav_24bit_medium
+        variant_audio_paths['nolimiter'] = wav_24bit_no_limiter
+        variant_audio_paths['nolimiter_normalized'] = wav_24bit_no_limiter_normalized
+        for variant, variant_result in variant_results.items():
+            variant_audio_paths[variant] = variant_result.file
         
         preview_paths = {
             'original': preview_original_wav,
@@ -360,8 +350,9 @@ def process_mastering(target_path, reference_path, job_id, reference_index, limi
             target_path=str(target_path),
             variant_audio_paths=variant_audio_paths,
             preview_output_paths=preview_paths,
-            config=build_config(resolve_limiter_settings('medium', limiter_settings)),
-            temp_folder=str(session_folder),
+            config=config,
+            preview_window=preview_window,
+            sample_rate=sample_rate,
         )
         
         return {
@@ -423,68 +414,97 @@ def upload_files():
         if len(reference_files) > MAX_REFERENCES:
             return jsonify({'error': f'Maximum {MAX_REFERENCES} reference files allowed'}), 400
         
+        # The slots are reserved before anything is written, so a busy server rejects cheaply
+        global pending_masterings
+        with pending_lock:
+            if pending_masterings + len(reference_files) > MAX_PENDING_MASTERINGS:
+                return jsonify({'error': 'The server is busy, please try again later'}), 503
+            pending_masterings += len(reference_files)
+        
         # Generate job ID
         job_id = str(uuid.uuid4())
         job_folder = UPLOAD_FOLDER / job_id
-        job_folder.mkdir(exist_ok=True)
-        
-        # Save target file
-        target_filename = secure_filename(target_file.filename)
-        target_path = job_folder / target_filename
-        target_file.save(str(target_path))
-        
-        # Save reference files
-        reference_paths = []
-        for idx, ref_file in enumerate(reference_files, 1):
-            ref_filename = secure_filename(ref_file.filename)
-            ref_path = job_folder / f"reference_{idx}_{ref_filename}"
-            ref_file.save(str(ref_path))
-            reference_paths.append((idx, str(ref_path)))
-        
-        # Initialize processing job
-        processing_jobs[job_id] = {
-            'status': 'processing',
-            'total': len(reference_paths),
-            'completed': 0,
-            'results': [],
-            'errors': [],
-            'target_path': str(target_path),
-            'limiter_settings': limiter_settings
-        }
-        
-        # Initialize voting data
-        voting_data[job_id] = {
-            'masterings': {},
-            'votes': {},
-            'rankings': []
-        }
-        
-        # Process all masterings in separate threads
-        def process_all():
-            results = []
-            for ref_idx, ref_path in reference_paths:
-                result = process_mastering(target_path, ref_path, job_id, ref_idx, limiter_settings=limiter_settings)
-                results.append(result)
-                processing_jobs[job_id]['completed'] += 1
-                if result['success']:
-                    processing_jobs[job_id]['results'].append(result)
-                    # Initialize voting for this mastering
-                    mastering_id = f"{job_id}_ref_{ref_idx}"
-                    voting_data[job_id]['masterings'][mastering_id] = {
-                        'id': mastering_id,
-                        'reference_index': ref_idx,
-                        'votes': 0,
-                        'wins': 0,
-                        'losses': 0
-                    }
-                else:
-                    processing_jobs[job_id]['errors'].append(result)
+        job_created = False
+        submitted = set()
+        try:
+            job_folder.mkdir(exist_ok=True)
             
-            processing_jobs[job_id]['status'] = 'completed'
-        
-        thread = threading.Thread(target=process_all)
-        thread.daemon = True
-        thread.start()
+            # Save target file
+            target_filename = secure_filename(target_file.filename)
+            target_path = job_folder / target_filename
+            target_file.save(str(target_path))
+            
+            # Save reference files
+            reference_paths = []
+            for idx, ref_file in enumerate(reference_files, 1):
+                ref_filename = secure_filename(ref_file.filename)
+                ref_path = job_folder / f"reference_{idx}_{ref_filename}"
+                ref_file.save(str(ref_path))
+                reference_paths.append((idx, str(ref_path)))
+            
+            # Only the headers are read, so unsupported, multichannel or too long files
+            # are rejected right away instead of failing in a worker after decoding
+            max_length = Config().max_length
+            try:
+                mg_probe(str(target_path), "target", max_length)
+                for _, ref_path in reference_paths:
+                    mg_probe(ref_path, "reference", max_length)
+            except ModuleError as probe_error:
+                # No job refers to the rejected upload, so nothing else would remove it
+                shutil.rmtree(job_folder, ignore_errors=True)
+                return jsonify({'error': str(probe_error)}), 400
+            
+            # Initialize processing job and its voting data
+            job_store.create_job(job_id, len(reference_paths), str(target_path), limiter_settings)
+            job_created = True
+            
+            def on_mastering_done(ref_idx, future):
+                global pending_masterings
+                try:
+                    result = future.result()
+                except Exception as e:
+                    # The worker process itself has failed
+                    result = {'success': False, 'reference_index': ref_idx, 'error': str(e)}
+                with pending_lock:
+                    pending_masterings -= 1
+                try:
+                    # Successful masterings become available for voting
+                    job_store.add_result(job_id, result)
+                except Exception as e:
+                    print(f"Failed to store the result of reference {ref_idx} for job {job_id}: {e}")
+            
+            # Every reference is a separate task, so the masterings of one job run in parallel
+            # while the pool size caps the number of masterings across all jobs
+            pool = get_worker_pool()
+            for ref_idx, ref_path in reference_paths:
+                future = pool.submit(
+                    process_mastering,
+                    str(target_path),
+                    ref_path,
+                    job_id,
+                    ref_idx,
+                    limiter_settings,
+                )
+                # From here on the callback gives the slot back
+                submitted.add(ref_idx)
+                future.add_done_callback(
+                    lambda future, ref_idx=ref_idx: on_mastering_done(ref_idx, future)
+                )
+        except Exception as e:
+            # The references that never reached the pool fail, so the job can still complete
+            if job_created:
+                for ref_idx in range(1, len(reference_files) + 1):
+                    if ref_idx not in submitted:
+                        job_store.add_result(
+                            job_id, {'success': False, 'reference_index': ref_idx, 'error': str(e)}
+                        )
+            if not submitted:
+                shutil.rmtree(job_folder, ignore_errors=True)
+            raise
+        finally:
+            # Every slot that is not owned by a submitted task is given back
+            with pending_lock:
+                pending_masterings -= len(reference_files) - len(submitted)
         
         return jsonify({
             'job_id': job_id,
@@ -498,10 +518,10 @@ def upload_files():
 @app.route('/api/status/<job_id>')
 def get_status(job_id):
     """Get processing status for a job"""
-    if job_id not in processing_jobs:
+    job = job_store.get_job(job_id)
+    if job is None:
         return jsonify({'error': 'Job not found'}), 404
     
-    job = processing_jobs[job_id]
     return jsonify({
         'status': job['status'],
         'total': job['total'],
@@ -574,10 +594,11 @@ def get_preview_high(job_id, reference_index):
 @app.route('/api/original/<job_id>')
 def get_original(job_id):
     """Get original target file preview"""
-    if job_id not in processing_jobs:
+    job = job_store.get_job(job_id)
+    if job is None:
         return jsonify({'error': 'Job not found'}), 404
     
-    target_path = processing_jobs[job_id].get('target_path')
+    target_path = job.get('target_path')
     if target_path and Path(target_path).exists():
         return send_file(target_path, mimetype='audio/wav')
     return jsonify({'error': 'Original file not found'}), 404
@@ -616,8 +637,9 @@ def download_file(job_id, reference_index, format_type):
     
     if file_path.exists():
         # Generate download filename with random code
-        if job_id in processing_jobs:
-            target_path = processing_jobs[job_id].get('target_path', '')
+        job = job_store.get_job(job_id)
+        if job is not None:
+            target_path = job.get('target_path', '')
             if target_path:
                 original_name = Path(target_path).stem
                 import random
@@ -640,26 +662,11 @@ def vote():
     if not all([job_id, winner_id, loser_id]):
         return jsonify({'error': 'Missing required fields'}), 400
     
-    if job_id not in voting_data:
+    # Update vote counts and rankings in one atomic step
+    rankings = job_store.record_vote(job_id, winner_id, loser_id)
+    if rankings is None:
         return jsonify({'error': 'Job not found'}), 404
     
-    # Update vote counts
-    if winner_id in voting_data[job_id]['masterings']:
-        voting_data[job_id]['masterings'][winner_id]['votes'] += 1
-        voting_data[job_id]['masterings'][winner_id]['wins'] += 1
-    
-    if loser_id in voting_data[job_id]['masterings']:
-        voting_data[job_id]['masterings'][loser_id]['losses'] += 1
-    
-    # Update rankings
-    masterings = voting_data[job_id]['masterings']
-    rankings = sorted(
-        masterings.values(),
-        key=lambda x: (x['wins'], x['votes']),
-        reverse=True
-    )
-    voting_data[job_id]['rankings'] = rankings
-    
     return jsonify({
         'success': True,
         'rankings': rankings
@@ -668,32 +675,32 @@ def vote():
 @app.route('/api/rankings/<job_id>')
 def get_rankings(job_id):
     """Get current rankings for a job"""
-    if job_id not in voting_data:
+    masterings = job_store.get_masterings(job_id)
+    if masterings is None:
         return jsonify({'error': 'Job not found'}), 404
     
     return jsonify({
-        'rankings': voting_data[job_id]['rankings'],
-        'masterings': voting_data[job_id]['masterings']
+        'rankings': rank_masterings(masterings.values()),
+        'masterings': masterings
     })
 
 @app.route('/api/next-comparison/<job_id>')
 def get_next_comparison(job_id):
     """Get next two masterings to compare"""
-    if job_id not in voting_data:
+    masterings = job_store.get_masterings(job_id)
+    if masterings is None:
         return jsonify({'error': 'Job not found'}), 404
     
-    masterings = list(voting_data[job_id]['masterings'].keys())
-    
     if len(masterings) < 2:
         return jsonify({'error': 'Not enough masterings to compare'}), 400
     
     # Improved algorithm: prefer comparing masterings with fewer comparisons
     # NEVER show the same mastering twice
     import random
-    mastering_list = list(voting_data[job_id]['masterings'].values())
+    mastering_list = list(masterings.values())
     
     # Get last comparison IDs to avoid repetition
-    last_comparison = voting_data[job_id].get('last_comparison', [])
+    last_comparison = job_store.get_last_comparison(job_id)
     
     # Filter out masterings that were in last comparison
     available_masterings = [m for m in mastering_list if m['id'] not in last_comparison]
@@ -742,7 +749,7 @@ def get_next_comparison(job_id):
     
     # Store this comparison to avoid repetition
     comparison_ids = [selected[0]['id'], selected[1]['id']]
-    voting_data[job_id]['last_comparison'] = comparison_ids
+    job_store.set_last_comparison(job_id, comparison_ids)
     
     return jsonify({
         'mastering_1': {
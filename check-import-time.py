@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+"""Helper script to check the cold import time of the matchering package
+
+Usage: python check-import-time.py [budget in milliseconds, default 500]
+"""
+import subprocess
+import sys
+
+HEAVY_MODULES = ("scipy", "statsmodels", "resampy")
+
+budget = float(sys.argv[1]) if len(sys.argv) > 1 else 500.0
+
+# A fresh interpreter, so nothing is imported or cached by this script
+process = subprocess.run(
+    [
+        sys.executable,
+        "-X",
+        "importtime",
+        "-c",
+        "import sys, matchering; "
+        f"print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))",
+    ],
+    capture_output=True,
+    text=True,
+)
+if process.returncode != 0:
+    print(process.stderr)
+    sys.exit(2)
+
+# import time: self [us] | cumulative | imported package
+imports = []
+for line in process.stderr.splitlines():
+    if not line.startswith("import time:") or "cumulative" in line:
+        continue
+    own, cumulative, name = line[len("import time:"):].split("|")
+    imports.append((int(own), int(cumulative), name.strip()))
+
+total = next(us for _, us, name in imports if name == "matchering") / 1000
+print(f"import matchering: {total:.1f} ms (budget {budget:.1f} ms)")
+print("The slowest modules (self time):")
+for own, _, name in sorted(imports, reverse=True)[:10]:
+    print(f"{own / 1000:10.1f} ms  {name}")
+
+heavy = process.stdout.strip()
+if heavy:
+    print(f"Heavy modules are imported eagerly: {heavy}")
+    sys.exit(1)
+if total > budget:
+    print("The import time budget is exceeded")
+    sys.exit(1)
@@ -30,3 +30,27 @@ mg.process(
         # https://pysoundfile.readthedocs.io/en/latest/#soundfile.available_subtypes
     ],
 )
+
+# Several limiter variants of the same master can be rendered in a single call
+# The matching is done once, then every variant gets its own limiter pass
+mg.process(
+    target="my_song.wav",
+    reference="some_popular_song.wav",
+    results=[
+        # Uses Config.limiter and Config.threshold
+        mg.pcm24("my_song_master_medium.wav"),
+        # Overrides the limiter release time for this result only
+        mg.Result(
+            "my_song_master_low.wav",
+            subtype="PCM_24",
+            limiter=mg.LimiterConfig(release=4000),
+        ),
+        # Overrides both the limiter and its threshold
+        mg.Result(
+            "my_song_master_high.wav",
+            subtype="PCM_24",
+            limiter=mg.LimiterConfig(release=250),
+            threshold=0.7079,  # -3 dB
+        ),
+    ],
+)
@@ -0,0 +1,29 @@
+import matchering as mg
+from matchering.batch import Job, process_batch
+
+# The guard is required on the platforms that spawn worker processes (Windows, macOS)
+if __name__ == "__main__":
+    # Let's keep info and warning outputs here, muting out the debug ones
+    mg.log(info_handler=print, warning_handler=print)
+
+    # The same reference profile can be shared by all jobs
+    reference = mg.analyze_reference("some_popular_song.wav")
+
+    jobs = [
+        # A job is a (target, reference, results) tuple...
+        ("song_1.wav", reference, [mg.pcm24("song_1_master.wav")]),
+        ("song_2.wav", reference, [mg.pcm24("song_2_master.wav")]),
+        # ...or a Job instance with its own config and previews
+        Job(
+            "song_3.wav",
+            reference,
+            [mg.pcm24("song_3_master.wav")],
+            preview_result=mg.pcm16("song_3_preview.flac"),
+        ),
+    ]
+
+    # Use one worker process per CPU core by default
+    for job_result in process_batch(jobs):
+        if not job_result.success:
+            # job_result.code holds the matchering log code of the error
+            print(f"{job_result.job.target}: {job_result.error}")
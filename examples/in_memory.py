@@ -0,0 +1,28 @@
+import soundfile as sf
+import matchering as mg
+
+# Let's keep info and warning outputs here, muting out the debug ones
+mg.log(info_handler=print, warning_handler=print)
+
+# Any (samples,) or (samples, channels) float arrays will do, e.g. decoded by your own service
+target, sample_rate = sf.read("my_song.wav", always_2d=True)
+reference, reference_sample_rate = sf.read("some_popular_song.wav", always_2d=True)
+assert sample_rate == reference_sample_rate
+
+# Nothing is written to disk, the results are returned at Config.internal_sample_rate
+# Everything that was not requested is returned as None
+(
+    result,
+    result_no_limiter,
+    result_no_limiter_normalized,
+    target_preview,
+    result_preview,
+) = mg.process_arrays(
+    target,
+    reference,
+    sample_rate,
+    need_no_limiter_normalized=True,
+    need_preview=True,
+)
+
+sf.write("my_song_master.flac", result, mg.Config().internal_sample_rate, "PCM_24")
@@ -0,0 +1,26 @@
+import matchering as mg
+
+# Let's keep info and warning outputs here, muting out the debug ones
+mg.log(info_handler=print, warning_handler=print)
+
+references = ["some_popular_song.wav", "another_popular_song.wav", "one_more_song.flac"]
+
+# The target is loaded and analyzed only once,
+# then it is matched to every reference, up to 3 references at a time
+outcomes = mg.process_many(
+    target="my_song.wav",
+    references=references,
+    # Every reference gets its own list of results
+    results=[[mg.pcm24(f"my_song_master_{idx}.wav")] for idx in range(len(references))],
+    workers=3,
+)
+
+# A failed reference does not stop the others, its exception is returned instead
+# of the ((start, end), sample_rate) preview window that process() returns
+for reference, outcome in zip(references, outcomes):
+    if isinstance(outcome, Exception):
+        print(f"{reference}: {outcome}")
+
+# The target analysis can also be reused across separate process() calls
+target = mg.analyze_target("my_song.wav")
+mg.process(target, "some_popular_song.wav", [mg.pcm16("my_song_master_16bit.wav")])
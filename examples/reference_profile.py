@@ -0,0 +1,18 @@
+import matchering as mg
+
+# Let's keep info and warning outputs here, muting out the debug ones
+mg.log(info_handler=print, warning_handler=print)
+
+# Analyze the reference once and store its profile in a compact .npz file
+# The profile is only valid for the config it was created with
+profile = mg.analyze_reference("some_popular_song.wav")
+profile.save("some_popular_song.npz")
+
+# Later, possibly in another process, load the profile and use it instead of the reference file
+mg.process(
+    target="my_song.wav",
+    reference=mg.ReferenceProfile.load("some_popular_song.npz"),
+    results=[
+        mg.pcm16("my_song_master_16bit.wav"),
+    ],
+)
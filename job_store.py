@@ -0,0 +1,334 @@
+# -*- coding: utf-8 -*-
+
+"""
+Matchering 2025 - Multi-Reference Hot or Not Web Application
+Job and voting storage for the Flask server
+
+Based on Matchering 2.0 by Sergree
+Modified 2025
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import copy
+import json
+import threading
+from datetime import datetime
+
+try:
+    import sqlite3
+except ImportError:  # Python builds without SQLite support
+    sqlite3 = None
+
+
+def new_mastering(job_id, reference_index):
+    """Build the voting entry of a successful mastering."""
+    return {
+        'id': f"{job_id}_ref_{reference_index}",
+        'reference_index': reference_index,
+        'votes': 0,
+        'wins': 0,
+        'losses': 0
+    }
+
+
+def rank_masterings(masterings):
+    """Sort masterings from the most to the least preferred one."""
+    return sorted(
+        masterings,
+        key=lambda x: (x['wins'], x['votes']),
+        reverse=True
+    )
+
+
+class MemoryJobStore:
+    """Keeps jobs and votes in the memory of a single server process."""
+
+    def __init__(self):
+        self.jobs = {}
+        self.voting = {}
+        self.lock = threading.Lock()
+
+    def create_job(self, job_id, total, target_path, limiter_settings):
+        """Register a new job that waits for `total` masterings."""
+        with self.lock:
+            self.jobs[job_id] = {
+                'status': 'processing',
+                'total': total,
+                'completed': 0,
+                'results': [],
+                'errors': [],
+                'target_path': target_path,
+                'limiter_settings': limiter_settings
+            }
+            self.voting[job_id] = {
+                'masterings': {},
+                'last_comparison': []
+            }
+
+    def get_job(self, job_id):
+        """Return a snapshot of the job or None if it does not exist."""
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return copy.deepcopy(job) if job is not None else None
+
+    def add_result(self, job_id, result):
+        """Record a finished mastering and make it available for voting."""
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return
+            reported = {item['reference_index'] for item in job['results'] + job['errors']}
+            if result['reference_index'] in reported:
+                # A result reported twice for the same reference is only counted once
+                return
+            job['completed'] += 1
+            if result['success']:
+                job['results'].append(result)
+                job['results'].sort(key=lambda item: item['reference_index'])
+                mastering = new_mastering(job_id, result['reference_index'])
+                self.voting[job_id]['masterings'][mastering['id']] = mastering
+            else:
+                job['errors'].append(result)
+            if job['completed'] >= job['total']:
+                job['status'] = 'completed'
+
+    def get_masterings(self, job_id):
+        """Return the voting entries of a job or None if it does not exist."""
+        with self.lock:
+            voting = self.voting.get(job_id)
+            if voting is None:
+                return None
+            return copy.deepcopy(voting['masterings'])
+
+    def record_vote(self, job_id, winner_id, loser_id):
+        """Count a comparison and return the new rankings, or None for an unknown job."""
+        with self.lock:
+            voting = self.voting.get(job_id)
+            if voting is None:
+                return None
+            masterings = voting['masterings']
+            if winner_id in masterings:
+                masterings[winner_id]['votes'] += 1
+                masterings[winner_id]['wins'] += 1
+            if loser_id in masterings:
+                masterings[loser_id]['losses'] += 1
+            return copy.deepcopy(rank_masterings(masterings.values()))
+
+    def get_last_comparison(self, job_id):
+        """Return the IDs of the previously offered comparison."""
+        with self.lock:
+            voting = self.voting.get(job_id)
+            return list(voting['last_comparison']) if voting is not None else []
+
+    def set_last_comparison(self, job_id, comparison_ids):
+        """Remember the offered comparison so that it is not repeated."""
+        with self.lock:
+            if job_id in self.voting:
+                self.voting[job_id]['last_comparison'] = list(comparison_ids)
+
+
+class SQLiteJobStore:
+    """Keeps jobs and votes in a SQLite database shared by all server processes."""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS jobs (
+            job_id TEXT PRIMARY KEY,
+            status TEXT NOT NULL,
+            total INTEGER NOT NULL,
+            completed INTEGER NOT NULL DEFAULT 0,
+            target_path TEXT,
+            limiter_settings TEXT NOT NULL DEFAULT '{}',
+            last_comparison TEXT NOT NULL DEFAULT '[]',
+            created_at TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS results (
+            job_id TEXT NOT NULL REFERENCES jobs (job_id),
+            reference_index INTEGER NOT NULL,
+            success INTEGER NOT NULL,
+            data TEXT NOT NULL,
+            PRIMARY KEY (job_id, reference_index)
+        );
+        CREATE TABLE IF NOT EXISTS masterings (
+            id TEXT PRIMARY KEY,
+            job_id TEXT NOT NULL REFERENCES jobs (job_id),
+            reference_index INTEGER NOT NULL,
+            votes INTEGER NOT NULL DEFAULT 0,
+            wins INTEGER NOT NULL DEFAULT 0,
+            losses INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS masterings_job_id ON masterings (job_id);
+    """
+
+    def __init__(self, path, timeout=30.0):
+        if sqlite3 is None:
+            raise RuntimeError('SQLite is not available in this Python build')
+        self.path = str(path)
+        self.timeout = timeout
+        connection = self._connect()
+        try:
+            # WAL lets the status polling of other workers read while a vote is written
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.executescript(self.SCHEMA)
+        finally:
+            connection.close()
+
+    def _connect(self):
+        # One short-lived connection per call, so the store is safe to use from the
+        # request threads and the worker pool callbacks alike. Autocommit mode is used
+        # and every write opens an explicit transaction with BEGIN IMMEDIATE
+        connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+        connection.row_factory = sqlite3.Row
+        return connection
+
+    def _read(self, query, params=()):
+        connection = self._connect()
+        try:
+            return connection.execute(query, params).fetchall()
+        finally:
+            connection.close()
+
+    def _write(self, operation):
+        connection = self._connect()
+        try:
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                value = operation(connection)
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+            connection.execute('COMMIT')
+            return value
+        finally:
+            connection.close()
+
+    def create_job(self, job_id, total, target_path, limiter_settings):
+        """Register a new job that waits for `total` masterings."""
+        self._write(lambda connection: connection.execute(
+            'INSERT INTO jobs (job_id, status, total, target_path, limiter_settings, created_at) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (job_id, 'processing', total, target_path, json.dumps(limiter_settings),
+             datetime.now().isoformat())
+        ))
+
+    def get_job(self, job_id):
+        """Return a snapshot of the job or None if it does not exist."""
+        connection = self._connect()
+        try:
+            job = connection.execute(
+                'SELECT * FROM jobs WHERE job_id = ?', (job_id,)
+            ).fetchone()
+            if job is None:
+                return None
+            results = connection.execute(
+                'SELECT success, data FROM results WHERE job_id = ? ORDER BY reference_index',
+                (job_id,)
+            ).fetchall()
+        finally:
+            connection.close()
+        return {
+            'status': job['status'],
+            'total': job['total'],
+            'completed': job['completed'],
+            'results': [json.loads(row['data']) for row in results if row['success']],
+            'errors': [json.loads(row['data']) for row in results if not row['success']],
+            'target_path': job['target_path'],
+            'limiter_settings': json.loads(job['limiter_settings'])
+        }
+
+    def add_result(self, job_id, result):
+        """Record a finished mastering and make it available for voting."""
+        def operation(connection):
+            inserted = connection.execute(
+                'INSERT OR IGNORE INTO results (job_id, reference_index, success, data) '
+                'VALUES (?, ?, ?, ?)',
+                (job_id, result['reference_index'], int(bool(result['success'])),
+                 json.dumps(result))
+            ).rowcount
+            if not inserted:
+                # A result reported twice for the same reference is only counted once
+                return
+            connection.execute(
+                "UPDATE jobs SET completed = completed + 1, "
+                "status = CASE WHEN completed + 1 >= total THEN 'completed' ELSE status END "
+                "WHERE job_id = ?",
+                (job_id,)
+            )
+            if result['success']:
+                mastering = new_mastering(job_id, result['reference_index'])
+                connection.execute(
+                    'INSERT OR IGNORE INTO masterings (id, job_id, reference_index) '
+                    'VALUES (?, ?, ?)',
+                    (mastering['id'], job_id, mastering['reference_index'])
+                )
+        self._write(operation)
+
+    def _masterings(self, connection, job_id):
+        rows = connection.execute(
+            'SELECT id, reference_index, votes, wins, losses FROM masterings '
+            'WHERE job_id = ? ORDER BY reference_index',
+            (job_id,)
+        ).fetchall()
+        return {row['id']: dict(row) for row in rows}
+
+    def get_masterings(self, job_id):
+        """Return the voting entries of a job or None if it does not exist."""
+        connection = self._connect()
+        try:
+            if connection.execute(
+                'SELECT 1 FROM jobs WHERE job_id = ?', (job_id,)
+            ).fetchone() is None:
+                return None
+            return self._masterings(connection, job_id)
+        finally:
+            connection.close()
+
+    def record_vote(self, job_id, winner_id, loser_id):
+        """Count a comparison and return the new rankings, or None for an unknown job."""
+        def operation(connection):
+            if connection.execute(
+                'SELECT 1 FROM jobs WHERE job_id = ?', (job_id,)
+            ).fetchone() is None:
+                return None
+            # The counters are incremented by the database, so concurrent votes are never lost
+            connection.execute(
+                'UPDATE masterings SET votes = votes + 1, wins = wins + 1 '
+                'WHERE id = ? AND job_id = ?',
+                (winner_id, job_id)
+            )
+            connection.execute(
+                'UPDATE masterings SET losses = losses + 1 WHERE id = ? AND job_id = ?',
+                (loser_id, job_id)
+            )
+            return rank_masterings(self._masterings(connection, job_id).values())
+        return self._write(operation)
+
+    def get_last_comparison(self, job_id):
+        """Return the IDs of the previously offered comparison."""
+        rows = self._read('SELECT last_comparison FROM jobs WHERE job_id = ?', (job_id,))
+        return json.loads(rows[0]['last_comparison']) if rows else []
+
+    def set_last_comparison(self, job_id, comparison_ids):
+        """Remember the offered comparison so that it is not repeated."""
+        self._write(lambda connection: connection.execute(
+            'UPDATE jobs SET last_comparison = ? WHERE job_id = ?',
+            (json.dumps(list(comparison_ids)), job_id)
+        ))
+
+
+def create_job_store(location):
+    """Open the job store at `location`: a SQLite file path or 'memory'."""
+    if location == 'memory' or sqlite3 is None:
+        return MemoryJobStore()
+    return SQLiteJobStore(location)
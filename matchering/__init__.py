@@ -30,7 +30,15 @@ __version__ = "2.0.6"
 
 from .log.handlers import set_handlers as log
 from .results import Result, pcm16, pcm24
-from .defaults import Config
-from .core import process
-from .loader import load
+from .defaults import Config, LimiterConfig
+from .profiles import ReferenceProfile, TargetProfile
+from .core import (
+    process,
+    process_many,
+    process_arrays,
+    analyze_reference,
+    analyze_target,
+)
+from .batch import Job, JobResult, process_batch
+from .loader import load, probe
 from .checker import check
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+"""
+Matchering - Audio Matching and Mastering Python Library
+Copyright (C) 2016-2022 Sergree
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os
+from multiprocessing import Pool
+from .log import Code, info, debug, debug_line, ModuleError
+from . import Config, Result
+from .core import process
+
+
+class Job:
+    def __init__(
+        self,
+        target,
+        reference,
+        results: list,
+        config: Config = Config(),
+        preview_target: Result = None,
+        preview_result: Result = None,
+    ):
+        self.target = target
+        self.reference = reference
+        self.results = results
+        self.config = config
+        self.preview_target = preview_target
+        self.preview_result = preview_result
+
+
+class JobResult:
+    def __init__(self, job: Job, code: Code = None, error: str = None):
+        self.job = job
+        # None if the job has succeeded
+        self.code = code
+        self.error = error
+
+    @property
+    def success(self) -> bool:
+        return self.code is None
+
+
+def __run_job(job: Job) -> JobResult:
+    try:
+        process(
+            job.target,
+            job.reference,
+            job.results,
+            job.config,
+            job.preview_target,
+            job.preview_result,
+        )
+    except ModuleError as e:
+        return JobResult(job, e.code, str(e))
+    except Exception as e:
+        return JobResult(job, Code.ERROR_UNKNOWN, f"{type(e).__name__}: {e}")
+    return JobResult(job)
+
+
+def process_batch(
+    jobs: list, workers: int = None, max_jobs_per_worker: int = 1
+) -> list:
+    # Every job is either a Job or a (target, reference, results) tuple.
+    # Worker processes are replaced after max_jobs_per_worker jobs,
+    # so the memory held by one job is returned to the system before the next one
+    jobs = [job if isinstance(job, Job) else Job(*job) for job in jobs]
+    workers = workers if workers else os.cpu_count()
+    assert workers > 0
+    assert max_jobs_per_worker is None or max_jobs_per_worker > 0
+
+    debug_line()
+    debug(f"Processing {len(jobs)} jobs with {workers} worker processes...")
+
+    job_results = []
+    with Pool(processes=workers, maxtasksperchild=max_jobs_per_worker) as pool:
+        for idx, job_result in enumerate(pool.imap(__run_job, jobs), 1):
+            if job_result.success:
+                debug(f"Job #{idx} of {len(jobs)} is completed")
+            else:
+                debug(f"Job #{idx} of {len(jobs)} has failed: {job_result.error}")
+            job_results.append(job_result)
+
+    debug_line()
+    info(Code.INFO_COMPLETED)
+
+    return job_results
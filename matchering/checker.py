@@ -19,17 +19,12 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
 import numpy as np
-try:
-    from resampy import resample
-    RESAMPY_AVAILABLE = True
-except ImportError:
-    # Fallback to scipy for Python 3.14+ compatibility
-    from scipy.signal import resample as scipy_resample
-    RESAMPY_AVAILABLE = False
 
 from .log import Code, warning, info, debug, ModuleError
 from . import Config
+from .profiles import ReferenceProfile, TargetProfile
 from .dsp import size, is_mono, is_stereo, mono_to_stereo, count_max_peaks
+from .resampler import resample
 from .utils import time_str
 
 
@@ -37,6 +32,7 @@ def __check_sample_rate(
     array: np.ndarray,
     sample_rate: int,
     required_sample_rate: int,
+    quality: str,
     name: str,
     log_handler,
     log_code: Code,
@@ -45,17 +41,7 @@ def __check_sample_rate(
         debug(
             f"Resampling {name} audio from {sample_rate} Hz to {required_sample_rate} Hz..."
         )
-        if RESAMPY_AVAILABLE:
-            array = resample(array, sample_rate, required_sample_rate, axis=0)
-        else:
-            # Use scipy resample as fallback for Python 3.14+
-            num_samples = int(array.shape[0] * required_sample_rate / sample_rate)
-            if array.ndim == 1:
-                array = scipy_resample(array, num_samples)
-            else:
-                # scipy resample works on first axis by default
-                resampled = scipy_resample(array, num_samples, axis=0)
-                array = resampled
+        array = resample(array, sample_rate, required_sample_rate, quality)
         log_handler(log_code)
     return array, required_sample_rate
 
@@ -134,6 +120,7 @@ def check(
         array,
         sample_rate,
         config.internal_sample_rate,
+        config.resampling_quality,
         name,
         warning if name == "TARGET" else info,
         Code.WARNING_TARGET_IS_RESAMPLED
@@ -156,3 +143,26 @@ def check(
 def check_equality(target: np.ndarray, reference: np.ndarray) -> None:
     if target.shape == reference.shape and np.allclose(target, reference):
         raise ModuleError(Code.ERROR_TARGET_EQUALS_REFERENCE)
+
+
+def check_reference_profile(profile: ReferenceProfile, config: Config) -> None:
+    debug(
+        f"REFERENCE profile: {profile.sample_rate} Hz, FFT size {profile.fft_size}, "
+        f"piece size {profile.max_piece_size} samples, threshold {profile.threshold}"
+    )
+    if (
+        profile.sample_rate != config.internal_sample_rate
+        or profile.fft_size != config.fft_size
+        or not np.isclose(profile.max_piece_size, config.max_piece_size)
+        or not np.isclose(profile.threshold, config.threshold)
+    ):
+        raise ModuleError(Code.ERROR_REFERENCE_PROFILE_IS_INCOMPATIBLE)
+
+
+def check_target_profile(profile: TargetProfile, config: Config) -> None:
+    if (
+        profile.sample_rate != config.internal_sample_rate
+        or profile.fft_size != config.fft_size
+        or not np.isclose(profile.max_piece_size, config.max_piece_size)
+    ):
+        raise ModuleError(Code.ERROR_TARGET_PROFILE_IS_INCOMPATIBLE)
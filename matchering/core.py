@@ -18,20 +18,308 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
+import os
+import copy
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from .log import Code, info, debug, debug_line, ModuleError
 from . import Config, Result
+from .profiles import ReferenceProfile, TargetProfile
 from .loader import load
-from .stages import main
-from .saver import save
-from .preview_creator import create_preview
+from .stages import match, finalize, create_reference_profile, create_target_profile
+from .saver import save_many
+from .preview_creator import create_preview_pieces, get_preview_window
 from .utils import get_temp_folder
-from .checker import check, check_equality
-from .dsp import channel_count, size
+from .checker import (
+    check,
+    check_equality,
+    check_reference_profile,
+    check_target_profile,
+)
+from .dsp import channel_count, size, is_1d
+
+
+def __validate(array: np.ndarray, sample_rate: int, config: Config) -> None:
+    # Validation of the most important conditions
+    if (
+        sample_rate != config.internal_sample_rate
+        or channel_count(array) != 2
+        or not size(array) > config.fft_size
+    ):
+        raise ModuleError(Code.ERROR_VALIDATION)
+
+
+def __get_native_config(sample_rate: int, config: Config) -> Config:
+    if config.native_sample_rate and sample_rate != config.internal_sample_rate:
+        debug(f"Processing at the native TARGET sample rate of {sample_rate} Hz")
+        return config.with_sample_rate(sample_rate)
+    return config
+
+
+def __check(array: np.ndarray, sample_rate: int, config: Config, name: str) -> np.ndarray:
+    if is_1d(array):
+        array = array[:, None]
+    array, sample_rate = check(array, sample_rate, config, name)
+
+    # Memory-mapped audio is only used if it is stored in config.dtype, so it is not copied here
+    if array.dtype != config.dtype:
+        array = array.astype(config.dtype)
+
+    __validate(array, sample_rate, config)
+    return array
+
+
+def __load_target(target: str, config: Config, temp_folder: str) -> (np.ndarray, Config):
+    # Load the target
+    target, target_sample_rate = load(
+        target,
+        "target",
+        temp_folder,
+        config.memory_map,
+        config.dtype,
+        None if config.native_sample_rate else config.internal_sample_rate,
+        config.max_length,
+    )
+    config = __get_native_config(target_sample_rate, config)
+    # Analyze the target
+    return __check(target, target_sample_rate, config, "target"), config
+
+
+def __load_reference(reference: str, config: Config, temp_folder: str) -> np.ndarray:
+    # Load the reference
+    reference, reference_sample_rate = load(
+        reference,
+        "reference",
+        temp_folder,
+        config.memory_map,
+        config.dtype,
+        config.internal_sample_rate,
+        config.max_length,
+    )
+    # Analyze the reference
+    return __check(reference, reference_sample_rate, config, "reference")
+
+
+def __get_file_folder(file: str, config: Config) -> str:
+    return config.temp_folder if config.temp_folder else os.path.dirname(
+        os.path.abspath(file)
+    )
+
+
+def __get_limiter_configs(results: list, config: Config) -> (list, list):
+    # Results with the same limiter variant share a single limiter pass
+    keys, limiter_configs, limiter_config_idxs = [], [], []
+    for result in results:
+        if not result.use_limiter:
+            limiter_config_idxs.append(None)
+            continue
+        key = (
+            sorted(vars(result.limiter).items()) if result.limiter else None,
+            result.threshold,
+            result.ceiling,
+        )
+        if key not in keys:
+            keys.append(key)
+            limiter_config = copy.copy(config)
+            if result.limiter is not None:
+                limiter_config.limiter = result.limiter
+            if result.threshold is not None:
+                limiter_config.threshold = result.threshold
+            if result.ceiling is not None:
+                limiter_config.post_limiter_ceiling = result.ceiling
+            limiter_configs.append(limiter_config)
+        limiter_config_idxs.append(keys.index(key))
+    return limiter_configs, limiter_config_idxs
+
+
+def __get_match_configs(reference, limiter_configs: list, config: Config) -> (list, list):
+    # The threshold also normalizes the REFERENCE, but only if the REFERENCE peaks below it.
+    # Limiter variants that normalize it the same way share a matching pass, the others get their own.
+    # A REFERENCE profile is already normalized, so its variants only change the limiter
+    if isinstance(reference, ReferenceProfile):
+        return [config], [0] * len(limiter_configs)
+    peak = np.abs(reference).max()
+
+    def key(threshold: float):
+        return threshold if peak < threshold else None
+
+    keys, match_configs, match_config_idxs = [key(config.threshold)], [config], []
+    for limiter_config in limiter_configs:
+        threshold_key = key(limiter_config.threshold)
+        if threshold_key not in keys:
+            keys.append(threshold_key)
+            match_config = copy.copy(config)
+            match_config.threshold = limiter_config.threshold
+            match_configs.append(match_config)
+        match_config_idxs.append(keys.index(threshold_key))
+    return match_configs, match_config_idxs
+
+
+def analyze_reference(reference: str, config: Config = Config()) -> ReferenceProfile:
+    debug_line()
+    info(Code.INFO_LOADING)
+
+    reference = __load_reference(
+        reference, config, __get_file_folder(reference, config)
+    )
+
+    debug_line()
+    info(Code.INFO_MATCHING_LEVELS)
+    profile = create_reference_profile(reference, config)
+
+    debug_line()
+    info(Code.INFO_COMPLETED)
+
+    return profile
+
+
+def analyze_target(target: str, config: Config = Config()) -> TargetProfile:
+    debug_line()
+    info(Code.INFO_LOADING)
+
+    target, config = __load_target(target, config, __get_file_folder(target, config))
+
+    debug_line()
+    info(Code.INFO_MATCHING_LEVELS)
+    profile = create_target_profile(target, config)
+
+    debug_line()
+    info(Code.INFO_COMPLETED)
+
+    return profile
+
+
+def __process_reference(
+    target,
+    reference,
+    results: list,
+    config: Config,
+    temp_folder: str,
+    preview_target: Result,
+    preview_result: Result,
+) -> ((int, int), int):
+    target_array = target.array if isinstance(target, TargetProfile) else target
+
+    if isinstance(reference, ReferenceProfile):
+        # The reference was analyzed beforehand, so there is nothing to load
+        debug("Using the precomputed REFERENCE profile")
+        check_reference_profile(reference, config)
+    else:
+        reference = __load_reference(reference, config, temp_folder)
+
+        # Analyze the target and the reference together
+        if not config.allow_equality:
+            check_equality(target_array, reference)
+
+    limiter_configs, limiter_config_idxs = __get_limiter_configs(results, config)
+    match_configs, match_config_idxs = __get_match_configs(
+        reference, limiter_configs, config
+    )
+    if len(limiter_configs) > len(match_configs):
+        debug(
+            f"{len(limiter_configs)} limiter variants will share "
+            f"{len(match_configs)} matching pass(es)"
+        )
+    if len(match_configs) > 1 and not isinstance(target, TargetProfile):
+        # The TARGET is analyzed once for all matching passes
+        target = create_target_profile(target, config)
+
+    need_no_limiter = any(not rr.use_limiter and not rr.normalize for rr in results)
+    need_no_limiter_normalized = any(not rr.use_limiter and rr.normalize for rr in results)
+
+    # Process: the results without a limiter always come from the pass with the main config
+    limited_results = [None] * len(limiter_configs)
+    result_no_limiter, result_no_limiter_normalized = None, None
+    for match_config_idx, match_config in enumerate(match_configs):
+        idxs = [
+            idx
+            for idx, config_idx in enumerate(match_config_idxs)
+            if config_idx == match_config_idx
+        ]
+        is_main = match_config_idx == 0
+        if not idxs and not (is_main and (need_no_limiter or need_no_limiter_normalized)):
+            continue
+
+        matched, final_amplitude_coefficient = match(target, reference, match_config)
+
+        if match_config_idx == len(match_configs) - 1:
+            del reference
+            if not (preview_target or preview_result):
+                del target, target_array
+
+        limited, no_limiter, no_limiter_normalized = finalize(
+            matched,
+            final_amplitude_coefficient,
+            [limiter_configs[idx] for idx in idxs],
+            need_no_limiter=is_main and need_no_limiter,
+            need_no_limiter_normalized=is_main and need_no_limiter_normalized,
+            config=config,
+        )
+        del matched
+        for idx, limited_result in zip(idxs, limited):
+            limited_results[idx] = limited_result
+        if is_main:
+            result_no_limiter, result_no_limiter_normalized = no_limiter, no_limiter_normalized
+
+    debug_line()
+    info(Code.INFO_EXPORTING)
+
+    # Save
+    outputs = []
+    for required_result, limiter_config_idx in zip(results, limiter_config_idxs):
+        if required_result.use_limiter:
+            correct_result = limited_results[limiter_config_idx]
+        else:
+            if required_result.normalize:
+                correct_result = result_no_limiter_normalized
+            else:
+                correct_result = result_no_limiter
+        outputs.append(
+            (
+                required_result.file,
+                correct_result,
+                required_result.subtype,
+                required_result.format,
+                "result",
+            )
+        )
+
+    # The loudest part of the main result is always located, so the previews of other files
+    # can be cut with preview_creator.read_preview_piece() without decoding them
+    result = next(
+        item
+        for item in [
+            *limited_results,
+            result_no_limiter,
+            result_no_limiter_normalized,
+        ]
+        if item is not None
+    )
+    preview_window = get_preview_window(result, config)
+
+    # Creating a preview (if needed), it is saved together with the results
+    if preview_target or preview_result:
+        target_piece, result_piece = create_preview_pieces(
+            target_array, result, config, preview_window
+        )
+        for preview, piece, name in (
+            (preview_target, target_piece, "target preview"),
+            (preview_result, result_piece, "result preview"),
+        ):
+            if preview:
+                outputs.append((preview.file, piece, preview.subtype, preview.format, name))
+
+    save_many(outputs, config.internal_sample_rate)
+
+    debug_line()
+    info(Code.INFO_COMPLETED)
+
+    return preview_window, config.internal_sample_rate
 
 
 def process(
-    target: str,
-    reference: str,
+    target,
+    reference,
     results: list,
     config: Config = Config(),
     preview_target: Result = None,
@@ -49,73 +337,168 @@ def process(
     # Get a temporary folder for converting mp3's
     temp_folder = config.temp_folder if config.temp_folder else get_temp_folder(results)
 
-    # Load the target
-    target, target_sample_rate = load(target, "target", temp_folder)
-    # Analyze the target
-    target, target_sample_rate = check(target, target_sample_rate, config, "target")
+    if isinstance(target, TargetProfile):
+        # The target was analyzed beforehand, so there is nothing to load
+        debug("Using the precomputed TARGET profile")
+        config = __get_native_config(target.sample_rate, config)
+        check_target_profile(target, config)
+    else:
+        target, config = __load_target(target, config, temp_folder)
 
-    # Load the reference
-    reference, reference_sample_rate = load(reference, "reference", temp_folder)
-    # Analyze the reference
-    reference, reference_sample_rate = check(
-        reference, reference_sample_rate, config, "reference"
+    # Returns ((start, end), sample_rate): the loudest preview window of the RESULT
+    # in samples at the sample rate of the saved files
+    return __process_reference(
+        target, reference, results, config, temp_folder, preview_target, preview_result
     )
 
-    # Analyze the target and the reference together
-    if not config.allow_equality:
-        check_equality(target, reference)
 
-    # Validation of the most important conditions
-    if (
-        not (target_sample_rate == reference_sample_rate == config.internal_sample_rate)
-        or not (channel_count(target) == channel_count(reference) == 2)
-        or not (size(target) > config.fft_size and size(reference) > config.fft_size)
-    ):
-        raise ModuleError(Code.ERROR_VALIDATION)
+def process_many(
+    target,
+    references: list,
+    results: list,
+    config: Config = Config(),
+    preview_targets: list = None,
+    preview_results: list = None,
+    workers: int = 1,
+) -> list:
+    # Masters one target against many references: the target is loaded and analyzed once,
+    # then every reference with its own result list is matched to it, optionally in parallel.
+    # Returns what process() returns, ((start, end), sample_rate), for every succeeded reference
+    # and the raised exception for every failed one
+    debug(
+        "Please give us a star to help the project: https://github.com/sergree/matchering"
+    )
+    debug_line()
+    info(Code.INFO_LOADING)
+
+    preview_targets = preview_targets or [None] * len(references)
+    preview_results = preview_results or [None] * len(references)
+    assert len(references) == len(results) == len(preview_targets) == len(preview_results)
+    assert workers > 0
+
+    if not all(results):
+        raise RuntimeError(f"The result list is empty")
+
+    if isinstance(target, TargetProfile):
+        debug("Using the precomputed TARGET profile")
+        config = __get_native_config(target.sample_rate, config)
+        check_target_profile(target, config)
+    else:
+        temp_folder = (
+            config.temp_folder if config.temp_folder else get_temp_folder(results[0])
+        )
+        target, config = __load_target(target, config, temp_folder)
+        target = create_target_profile(target, config)
+
+    def process_reference(idx: int):
+        temp_folder = (
+            config.temp_folder if config.temp_folder else get_temp_folder(results[idx])
+        )
+        try:
+            return __process_reference(
+                target,
+                references[idx],
+                results[idx],
+                config,
+                temp_folder,
+                preview_targets[idx],
+                preview_results[idx],
+            )
+        except Exception as e:
+            debug(f"Processing of the REFERENCE #{idx + 1} has failed: {e}")
+            return e
+
+    # NumPy and SciPy release the GIL inside the heavy FFT and filtering routines
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(process_reference, range(len(references))))
+
+
+def process_arrays(
+    target,
+    reference,
+    sample_rate: int,
+    config: Config = Config(),
+    need_default: bool = True,
+    need_no_limiter: bool = False,
+    need_no_limiter_normalized: bool = False,
+    need_preview: bool = False,
+) -> (np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray):
+    # In-memory counterpart of process(): takes (samples,) or (samples, channels) arrays
+    # at the given sample rate, or precomputed profiles, and returns the results
+    # at config.internal_sample_rate (or at the given sample rate with config.native_sample_rate)
+    # instead of saving them.
+    # Returns: result, result_no_limiter, result_no_limiter_normalized, target_preview, result_preview
+    # Everything that was not requested is None
+    debug_line()
+    info(Code.INFO_LOADING)
+
+    if not (need_default or need_no_limiter or need_no_limiter_normalized or need_preview):
+        raise RuntimeError(f"Neither a result nor a preview is requested")
+
+    if isinstance(target, TargetProfile):
+        debug("Using the precomputed TARGET profile")
+        config = __get_native_config(target.sample_rate, config)
+        check_target_profile(target, config)
+    else:
+        config = __get_native_config(sample_rate, config)
+        target = __check(target, sample_rate, config, "target")
+
+    target_array = target.array if isinstance(target, TargetProfile) else target
+
+    if isinstance(reference, ReferenceProfile):
+        debug("Using the precomputed REFERENCE profile")
+        check_reference_profile(reference, config)
+    else:
+        reference = __check(reference, sample_rate, config, "reference")
+
+        if not config.allow_equality:
+            check_equality(target_array, reference)
 
     # Process
-    result, result_no_limiter, result_no_limiter_normalized = main(
-        target,
-        reference,
-        config,
-        need_default=any(rr.use_limiter for rr in results),
-        need_no_limiter=any(not rr.use_limiter and not rr.normalize for rr in results),
-        need_no_limiter_normalized=any(
-            not rr.use_limiter and rr.normalize for rr in results
-        ),
-    )
+    result_no_limiter, final_amplitude_coefficient = match(target, reference, config)
 
     del reference
-    if not (preview_target or preview_result):
-        del target
+    if not need_preview:
+        del target, target_array
 
-    debug_line()
-    info(Code.INFO_EXPORTING)
+    # Only the preview is requested: it is made from the pre-limiter result
+    keep_no_limiter = need_no_limiter or (
+        need_preview and not need_default and not need_no_limiter_normalized
+    )
 
-    # Save
-    for required_result in results:
-        if required_result.use_limiter:
-            correct_result = result
-        else:
-            if required_result.normalize:
-                correct_result = result_no_limiter_normalized
-            else:
-                correct_result = result_no_limiter
-        save(
-            required_result.file,
-            correct_result,
-            config.internal_sample_rate,
-            required_result.subtype,
-        )
+    limited_results, result_no_limiter, result_no_limiter_normalized = finalize(
+        result_no_limiter,
+        final_amplitude_coefficient,
+        [config] if need_default else [],
+        keep_no_limiter,
+        need_no_limiter_normalized,
+        config,
+    )
 
-    # Creating a preview (if needed)
-    if preview_target or preview_result:
-        result = next(
-            item
-            for item in [result, result_no_limiter, result_no_limiter_normalized]
-            if item is not None
+    result = limited_results[0] if limited_results else None
+
+    target_preview, result_preview = None, None
+    if need_preview:
+        target_preview, result_preview = create_preview_pieces(
+            target_array,
+            next(
+                item
+                for item in [result, result_no_limiter, result_no_limiter_normalized]
+                if item is not None
+            ),
+            config,
         )
-        create_preview(target, result, config, preview_target, preview_result)
+
+    if not need_no_limiter:
+        result_no_limiter = None
 
     debug_line()
     info(Code.INFO_COMPLETED)
+
+    return (
+        result,
+        result_no_limiter,
+        result_no_limiter_normalized,
+        target_preview,
+        result_preview,
+    )
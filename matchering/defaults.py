@@ -18,7 +18,9 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
+import copy
 import math
+import numpy as np
 from .log import debug
 
 
@@ -33,6 +35,7 @@ class LimiterConfig:
         hold_filter_coefficient: float = 7,
         release_filter_order: int = 1,
         release_filter_coefficient: float = 800,
+        envelope_decimation: int = 1,
     ):
         assert attack > 0
         self.attack = attack
@@ -57,6 +60,12 @@ class LimiterConfig:
 
         self.release_filter_coefficient = release_filter_coefficient
 
+        # Compute the attack / hold / release envelopes at 1 / envelope_decimation of the sample rate
+        # and interpolate them back, the hard clip stage always runs at the full sample rate
+        assert envelope_decimation >= 1
+        assert isinstance(envelope_decimation, int)
+        self.envelope_decimation = envelope_decimation
+
 
 class Config:
     def __init__(
@@ -81,6 +90,13 @@ class Config:
         preview_fade_coefficient: float = 8,
         temp_folder: str = None,
         limiter: LimiterConfig = LimiterConfig(),
+        convolution_block_size: int = None,
+        memory_map: bool = False,
+        dtype=np.float64,
+        lowess_engine: str = "builtin",
+        resampling_quality: str = "high",
+        native_sample_rate: bool = False,
+        post_limiter_ceiling: float = None,
     ):
         assert internal_sample_rate > 0
         assert isinstance(internal_sample_rate, int)
@@ -153,3 +169,75 @@ class Config:
 
         assert isinstance(limiter, LimiterConfig)
         self.limiter = limiter
+
+        # None: convolve the whole track at once (fastest, but the peak memory usage grows with its length)
+        # int: stream the track through overlap-add convolution and the limiter in blocks of this many samples
+        assert convolution_block_size is None or (
+            isinstance(convolution_block_size, int) and convolution_block_size > 0
+        )
+        self.convolution_block_size = convolution_block_size
+
+        # Map the WAV files stored in the processing dtype (FLOAT for float32, DOUBLE for float64)
+        # to memory instead of reading them, the other files are read in dtype as usual
+        assert isinstance(memory_map, bool)
+        self.memory_map = memory_map
+
+        # The audio sample type used from loading to saving, float32 halves the memory traffic.
+        # The FIR design and the statistics are still done in float64
+        dtype = np.dtype(dtype)
+        assert dtype in (np.float32, np.float64)
+        self.dtype = dtype
+
+        # "builtin": vectorized LOWESS with cached weights, matches statsmodels to ~1e-13 with lowess_it=0.
+        # The robustness iterations match too, unless the median residual is exactly zero:
+        # then every nonzero residual gets zero weight, and both engines depend on the rounding
+        # "statsmodels": the reference implementation, requires the optional statsmodels package
+        assert lowess_engine in ("builtin", "statsmodels")
+        self.lowess_engine = lowess_engine
+
+        # "fast", "high", "best": polyphase resampling with the filters from resampler.QUALITY_TIERS
+        # "legacy": resampy, or the whole-signal FFT resampling of SciPy if resampy is not installed
+        assert resampling_quality in ("fast", "high", "best", "legacy")
+        self.resampling_quality = resampling_quality
+
+        # Process at the sample rate of the TARGET instead of internal_sample_rate,
+        # only the REFERENCE is resampled (see with_sample_rate)
+        assert isinstance(native_sample_rate, bool)
+        self.native_sample_rate = native_sample_rate
+
+        # Peak-normalize every limited RESULT to this ceiling in memory, before it is saved.
+        # Result(ceiling=...) overrides it for a single result
+        assert post_limiter_ceiling is None or 0 < post_limiter_ceiling <= 1
+        self.post_limiter_ceiling = post_limiter_ceiling
+
+    def with_sample_rate(self, sample_rate: int) -> "Config":
+        # A copy for another internal sample rate, with every length in samples scaled,
+        # so the durations, the frequency resolution and the smoothing width stay the same.
+        # LimiterConfig is defined in milliseconds and hertz, so it does not need scaling
+        assert sample_rate > 0
+        assert isinstance(sample_rate, int)
+        ratio = sample_rate / self.internal_sample_rate
+        config = copy.copy(self)
+        config.internal_sample_rate = sample_rate
+
+        config.fft_size = 2 ** max(1, round(math.log2(self.fft_size * ratio)))
+        # The log-frequency grid gets (or loses) octaves at the top, keep the width of LOWESS in octaves
+        config.lowess_frac = self.lowess_frac * (
+            math.log2(self.fft_size / 4) / math.log2(max(config.fft_size / 4, 2))
+        )
+
+        # Whole samples, as the sizes are used for slicing
+        def scale(value):
+            return round(value / self.internal_sample_rate * sample_rate)
+
+        config.max_piece_size = scale(self.max_piece_size)
+        config.preview_size = scale(self.preview_size)
+        config.preview_analysis_step = scale(self.preview_analysis_step)
+        config.preview_fade_size = scale(self.preview_fade_size)
+
+        config.clipping_samples_threshold = round(self.clipping_samples_threshold * ratio)
+        config.limited_samples_threshold = max(
+            round(self.limited_samples_threshold * ratio),
+            config.clipping_samples_threshold + 1,
+        )
+        return config
@@ -19,7 +19,7 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
 import numpy as np
-import statsmodels.api as sm
+from functools import lru_cache
 
 
 def size(array: np.ndarray) -> int:
@@ -54,14 +54,16 @@ def count_max_peaks(array: np.ndarray) -> (float, int):
     return max_value, max_count
 
 
+def lr_to_mid(array: np.ndarray) -> np.ndarray:
+    mid = array[:, 0] + array[:, 1]
+    mid *= 0.5
+    return mid
+
+
 def lr_to_ms(array: np.ndarray) -> (np.ndarray, np.ndarray):
-    array = np.copy(array)
-    array[:, 0] += array[:, 1]
-    array[:, 0] *= 0.5
-    mid = np.copy(array[:, 0])
-    array[:, 0] -= array[:, 1]
-    side = np.copy(array[:, 0])
-    return mid, side
+    # Only the two output channels are allocated
+    mid = lr_to_mid(array)
+    return mid, mid - array[:, 1]
 
 
 def ms_to_lr(mid_array: np.ndarray, side_array: np.ndarray) -> np.ndarray:
@@ -86,28 +88,123 @@ def batch_rms(array: np.ndarray) -> np.ndarray:
     return np.sqrt(np.squeeze(multiplicand @ multiplier, axis=(1, 2)) / piece_size)
 
 
-def amplify(array: np.ndarray, gain: float) -> np.ndarray:
-    return array * gain
+def amplify(array: np.ndarray, gain: float, inplace: bool = False) -> np.ndarray:
+    # Casting the gain keeps float32 arrays in float32.
+    # inplace: overwrite the array instead of allocating a new one, only for arrays owned by the caller
+    if inplace:
+        array *= array.dtype.type(gain)
+        return array
+    return array * array.dtype.type(gain)
 
 
 def normalize(
-    array: np.ndarray, threshold: float, epsilon: float, normalize_clipped: bool
+    array: np.ndarray,
+    threshold: float,
+    epsilon: float,
+    normalize_clipped: bool,
+    inplace: bool = False,
 ) -> (np.ndarray, float):
     coefficient = 1.0
     max_value = np.abs(array).max()
     if max_value < threshold or normalize_clipped:
         coefficient = max(epsilon, max_value / threshold)
-    return array / coefficient, coefficient
-
-
-def smooth_lowess(array: np.ndarray, frac: float, it: int, delta: float) -> np.ndarray:
-    return sm.nonparametric.lowess(
-        array, np.linspace(0, 1, len(array)), frac=frac, it=it, delta=delta
-    )[:, 1]
-
-
-def clip(array: np.ndarray, to: float = 1) -> np.ndarray:
-    return np.clip(array, -to, to)
+    if inplace:
+        array /= array.dtype.type(coefficient)
+        return array, coefficient
+    return array / array.dtype.type(coefficient), coefficient
+
+
+def __lowess_projection(
+    x: np.ndarray,
+    anchors: np.ndarray,
+    windows: np.ndarray,
+    tricube: np.ndarray,
+    resid_weights: np.ndarray,
+) -> (np.ndarray, np.ndarray):
+    # Weighted linear regressions at all anchors at once: fit = (projection * y[windows]).sum(1)
+    weights = tricube if resid_weights is None else tricube * resid_weights[windows]
+    reg_ok = np.count_nonzero(weights > 1e-12, axis=1) >= 2
+    # Like statsmodels, the weights of the skipped regressions are not normalized,
+    # they can all be zero after the robustness iterations
+    weights = weights / np.where(reg_ok, weights.sum(axis=1), 1.0)[:, None]
+
+    x_j = x[windows]
+    mean_x = np.einsum("ij,ij->i", weights, x_j)
+    deviation = x_j - mean_x[:, None]
+    variance = np.maximum(np.einsum("ij,ij->i", weights, deviation ** 2), 1e-12)
+    projection = weights * (
+        1 + (x[anchors] - mean_x)[:, None] * deviation / variance[:, None]
+    )
+    return projection, reg_ok
+
+
+@lru_cache(maxsize=8)
+def __lowess_kernel(
+    length: int, frac: float, delta: float
+) -> (np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray):
+    # Except for the y values, LOWESS depends only on the evenly spaced x grid,
+    # so the weights are computed once per (length, frac, delta) and reused for every FIR.
+    # Follows statsmodels.nonparametric.lowess step by step
+    x = np.linspace(0, 1, length)
+    k = min(max(int(frac * length + 1e-10), 2), length)
+
+    # The regressions are only fitted at the anchors, the points in between are interpolated
+    anchors = [0]
+    while anchors[-1] < length - 1:
+        i = anchors[-1]
+        cut = min(np.searchsorted(x, x[i] + delta, side="right"), length - 1)
+        anchors.append(max(cut - 1, i + 1))
+    anchors = np.array(anchors)
+
+    # The k nearest neighbours: the window slides right while its right edge is closer
+    middles = (x[: length - k] + x[k:]) / 2
+    left = np.searchsorted(middles, x[anchors], side="left")
+    windows = left[:, None] + np.arange(k)
+
+    radius = np.maximum(x[anchors] - x[left], x[left + k - 1] - x[anchors])
+    tricube = (1 - (np.abs(x[windows] - x[anchors, None]) / radius[:, None]) ** 3) ** 3
+
+    projection, reg_ok = __lowess_projection(x, anchors, windows, tricube, None)
+    for array in (x, anchors, windows, tricube, projection, reg_ok):
+        array.flags.writeable = False
+    return x, anchors, windows, tricube, projection, reg_ok
+
+
+def smooth_lowess(
+    array: np.ndarray, frac: float, it: int, delta: float, engine: str = "builtin"
+) -> np.ndarray:
+    if engine == "statsmodels":
+        import statsmodels.api as sm
+
+        return sm.nonparametric.lowess(
+            array, np.linspace(0, 1, len(array)), frac=frac, it=it, delta=delta
+        )[:, 1]
+
+    array = array.astype(np.float64, copy=False)
+    x, anchors, windows, tricube, projection, reg_ok = __lowess_kernel(
+        len(array), frac, delta
+    )
+    for iteration in range(it + 1):
+        if iteration > 0:
+            # Bisquare robustness weights of the residuals
+            residuals = np.abs(array - fit)
+            median = np.median(residuals)
+            if median == 0:
+                residuals = (residuals > 0).astype(np.float64)
+            else:
+                residuals = np.minimum(residuals / (6.0 * median), 1.0)
+            projection, reg_ok = __lowess_projection(
+                x, anchors, windows, tricube, (1.0 - residuals ** 2) ** 2
+            )
+        fit = np.where(
+            reg_ok, np.einsum("ij,ij->i", projection, array[windows]), array[anchors]
+        )
+        fit = np.interp(x, x[anchors], fit)
+    return fit
+
+
+def clip(array: np.ndarray, to: float = 1, inplace: bool = False) -> np.ndarray:
+    return np.clip(array, -to, to, out=array if inplace else None)
 
 
 def flip(array: np.ndarray) -> np.ndarray:
@@ -115,7 +212,10 @@ def flip(array: np.ndarray) -> np.ndarray:
 
 
 def rectify(array: np.ndarray, threshold: float) -> np.ndarray:
-    rectified = np.abs(array).max(1)
+    # Channel by channel, reducing over the short channel axis is several times slower
+    rectified = np.abs(array[:, 0])
+    for channel in range(1, channel_count(array)):
+        np.maximum(rectified, np.abs(array[:, channel]), out=rectified)
     rectified[rectified <= threshold] = threshold
     rectified /= threshold
     return rectified
@@ -139,13 +239,69 @@ def strided_app_2d(matrix: np.ndarray, batch_size: int, step: int) -> np.ndarray
     )
 
 
+def loudest_window(array: np.ndarray, window_size: int, step: int) -> int:
+    # The same as np.argmax(batch_rms_2d(strided_app_2d(array, window_size, step))),
+    # but the energy of every window comes from the prefix sums between the window boundaries,
+    # so the samples are squared once and the overlapping windows are never built
+    length = size(array)
+    if window_size > length:
+        return 0
+    starts = np.arange((length - window_size) // step + 1) * step
+    ends = starts + window_size
+
+    # Every sample belongs to exactly one segment between two neighbouring boundaries
+    positions = np.union1d(starts, ends)
+    segment_energies = []
+    for segment_start, segment_end in zip(positions[:-1], positions[1:]):
+        segment = array[segment_start:segment_end].astype(np.float64, copy=False)
+        segment_energies.append(np.vdot(segment, segment))
+    prefix_sums = np.concatenate(([0.0], np.cumsum(segment_energies)))
+
+    window_energies = (
+        prefix_sums[np.searchsorted(positions, ends)]
+        - prefix_sums[np.searchsorted(positions, starts)]
+    )
+    # The differences of the prefix sums are not exact, so windows with the same content
+    # may get slightly different energies. The first of the (nearly) loudest ones wins, like in np.argmax
+    return int(np.argmax(window_energies >= window_energies.max() * (1 - 1e-12)))
+
+
 def batch_rms_2d(array: np.ndarray) -> np.ndarray:
     return batch_rms(array.reshape(array.shape[0], array.shape[1] * array.shape[2]))
 
 
+def convolve_stream(blocks, fir: np.ndarray, block_size: int):
+    # Overlap-add convolution of a stream of 1D blocks (each no longer than block_size).
+    # Yields the "same"-sized output (like scipy.signal.fftconvolve(..., "same")) block by block,
+    # so only O(block_size + len(fir)) memory is used on top of the output
+    fir_size = len(fir)
+    offset = (fir_size - 1) // 2
+    fft_size = 1 << (block_size + fir_size - 2).bit_length()
+    fir_fft = np.fft.rfft(fir, fft_size)
+    tail = np.zeros(fir_size - 1)
+
+    input_size, output_size = 0, 0
+    for block in blocks:
+        block_size = len(block)
+        output = np.fft.irfft(np.fft.rfft(block, fft_size) * fir_fft, fft_size)
+        output = output[: block_size + fir_size - 1]
+        output[: fir_size - 1] += tail
+        tail = output[block_size:].copy()
+
+        # Skip the leading half of the FIR to get centered output
+        skip = max(0, offset - input_size)
+        input_size += block_size
+        if skip < block_size:
+            output_size += block_size - skip
+            yield output[skip:block_size]
+
+    # The tail starts at the output index of input_size
+    yield tail[offset + output_size - input_size : offset]
+
+
 def fade(array: np.ndarray, fade_size: int) -> np.ndarray:
     array = np.copy(array)
-    fade_in = np.linspace(0, 1, fade_size)
+    fade_in = np.linspace(0, 1, fade_size, dtype=array.dtype)
     fade_out = fade_in[::-1]
     array[:fade_size].T[:] *= fade_in
     array[size(array) - fade_size :].T[:] *= fade_out
@@ -11,4 +11,4 @@ Internal Matchering brickwall limiter based on the use of time constant and Butt
 
 """
 
-from .hyrax import limit
+from .hyrax import limit, StreamingLimiter
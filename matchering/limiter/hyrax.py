@@ -20,28 +20,44 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import numpy as np
 import math
-from scipy import signal
-from scipy.ndimage.filters import maximum_filter1d
 
 from .. import Config
 from ..log import debug
-from ..dsp import rectify, flip, max_mix
+from ..dsp import rectify, flip, max_mix, size, amplify
 from ..utils import make_odd, ms_to_samples
 
 
 def __sliding_window_fast(
     array: np.ndarray, window_size: int, mode: str = "attack"
 ) -> np.ndarray:
+    from scipy.ndimage import maximum_filter1d
+
     if mode == "attack":
         window_size = make_odd(window_size)
         return maximum_filter1d(array, size=(2 * window_size - 1))
     half_window_size = (window_size - 1) // 2
     array = np.pad(array, (half_window_size, 0))
-    return maximum_filter1d(array, size=window_size)[:-half_window_size]
+    return maximum_filter1d(array, size=window_size)[: len(array) - half_window_size]
+
+
+def __decimate(array: np.ndarray, factor: int) -> np.ndarray:
+    # Block maximum, so no gain reduction is lost between the decimated samples
+    array = np.pad(array, (0, -len(array) % factor))
+    return array.reshape(-1, factor).max(1)
+
+
+def __interpolate(array: np.ndarray, factor: int, length: int) -> np.ndarray:
+    # Every decimated sample is placed at the center of its block
+    positions = np.arange(len(array)) * factor + (factor - 1) / 2
+    return np.interp(np.arange(length), positions, array)
 
 
-def __process_attack(array: np.ndarray, config: Config) -> (np.ndarray, np.ndarray):
-    attack = ms_to_samples(config.limiter.attack, config.internal_sample_rate)
+def __process_attack(
+    array: np.ndarray, config: Config, sample_rate: float
+) -> (np.ndarray, np.ndarray):
+    from scipy import signal
+
+    attack = max(1, ms_to_samples(config.limiter.attack, sample_rate))
 
     slided_input = __sliding_window_fast(array, attack, mode="attack")
 
@@ -53,47 +69,290 @@ def __process_attack(array: np.ndarray, config: Config) -> (np.ndarray, np.ndarr
     return output, slided_input
 
 
-def __process_release(array: np.ndarray, config: Config) -> np.ndarray:
-    hold = ms_to_samples(config.limiter.hold, config.internal_sample_rate)
+def __process_release(array: np.ndarray, config: Config, sample_rate: float) -> np.ndarray:
+    from scipy import signal
+
+    hold = max(1, ms_to_samples(config.limiter.hold, sample_rate))
 
     slided_input = __sliding_window_fast(array, hold, mode="hold")
 
     b, a = signal.butter(
         config.limiter.hold_filter_order,
         config.limiter.hold_filter_coefficient,
-        fs=config.internal_sample_rate,
+        fs=sample_rate,
     )
     hold_output = signal.lfilter(b, a, slided_input)
 
     b, a = signal.butter(
         config.limiter.release_filter_order,
         config.limiter.release_filter_coefficient / config.limiter.release,
-        fs=config.internal_sample_rate,
+        fs=sample_rate,
     )
     release_output = signal.lfilter(b, a, np.maximum(slided_input, hold_output))
 
     return np.maximum(hold_output, release_output)
 
 
-def limit(array: np.ndarray, config: Config) -> np.ndarray:
+def __limit_blocks(
+    array: np.ndarray,
+    streaming_limiter: "StreamingLimiter",
+    block_size: int,
+    output_gain: float,
+) -> np.ndarray:
+    peak = max(np.abs(array[i : i + block_size]).max() for i in range(0, size(array), block_size))
+    if np.isclose(max(peak / streaming_limiter.config.threshold, 1.0), 1.0):
+        debug("The limiter is not needed!")
+        return amplify(array, output_gain)
+
+    result = np.empty_like(array)
+    position = 0
+
+    def write(output: np.ndarray) -> None:
+        nonlocal position
+        np.multiply(
+            output,
+            array.dtype.type(output_gain),
+            out=result[position : position + size(output)],
+        )
+        position += size(output)
+
+    for i in range(0, size(array), block_size):
+        write(streaming_limiter.process(array[i : i + block_size]))
+    # The last latency samples are only emitted by flush()
+    write(streaming_limiter.flush())
+    assert position == size(array)
+    return result
+
+
+def limit(array: np.ndarray, config: Config, output_gain: float = 1.0) -> np.ndarray:
+    # output_gain: a constant gain applied together with the gain envelope.
+    # The result is always a new array
 
     debug("The limiter is started. Preparing the gain envelope...")
+    if config.convolution_block_size and config.limiter.envelope_decimation == 1:
+        streaming_limiter = StreamingLimiter(config)
+        if size(array) > streaming_limiter.latency + streaming_limiter.attack_padding:
+            debug(
+                f"Streaming the gain envelope in blocks of {config.convolution_block_size} samples..."
+            )
+            return __limit_blocks(
+                array, streaming_limiter, config.convolution_block_size, output_gain
+            )
+
     rectified = rectify(array, config.threshold)
 
     if np.all(np.isclose(rectified, 1.0)):
         debug("The limiter is not needed!")
-        return array
+        del rectified
+        return amplify(array, output_gain)
 
     gain_hard_clip = flip(1.0 / rectified)
+
+    decimation = config.limiter.envelope_decimation
+    sample_rate = config.internal_sample_rate
+    envelope_input = gain_hard_clip
+    if decimation > 1:
+        debug(f"Decimating the gain envelope by {decimation}...")
+        envelope_input = __decimate(gain_hard_clip, decimation)
+        sample_rate /= decimation
+
     debug("Modifying the gain envelope: attack stage...")
     gain_attack, gain_hard_clip_slided = __process_attack(
-        np.copy(gain_hard_clip), config
+        np.copy(envelope_input), config, sample_rate
     )
 
     debug("Modifying the gain envelope: hold / release stage...")
-    gain_release = __process_release(np.copy(gain_hard_clip_slided), config)
+    gain_release = __process_release(np.copy(gain_hard_clip_slided), config, sample_rate)
 
     debug("Finalizing the gain envelope...")
-    gain = flip(max_mix(gain_hard_clip, gain_attack, gain_release))
+    gain_envelope = max_mix(gain_attack, gain_release)
+    if decimation > 1:
+        gain_envelope = __interpolate(gain_envelope, decimation, size(array))
+    # The full-rate hard clip gain keeps every sample under the threshold
+    gain = flip(max_mix(gain_hard_clip, gain_envelope))
+    if output_gain != 1.0:
+        gain *= output_gain
+
+    return array * gain.astype(array.dtype, copy=False)[:, None]
+
+
+class StreamingLimiter:
+    # Block-by-block version of limit(): feed the audio with process() and finish with flush().
+    # The output is delayed by the attack window plus the lookahead of the zero-phase attack filter,
+    # so process() returns fewer samples than it gets and flush() returns the rest.
+    # The lookahead is chosen so that the attack envelope differs from the offline one
+    # by less than `tolerance`, everything else is identical. The envelopes are always computed
+    # at the full sample rate, LimiterConfig.envelope_decimation is not used here
+    def __init__(self, config: Config, tolerance: float = 1e-12):
+        from scipy import signal
+
+        assert 0 < tolerance < 1
+        self.config = config
+
+        attack = ms_to_samples(config.limiter.attack, config.internal_sample_rate)
+        self.attack_window = make_odd(attack)
+        coef = math.exp(config.limiter.attack_filter_coefficient / attack)
+        self.attack_b, self.attack_a = np.array([1 - coef]), np.array([1, -coef])
+        self.attack_zi = signal.lfilter_zi(self.attack_b, self.attack_a)
+        # filtfilt extends both ends with this many odd-mirrored samples
+        self.attack_padding = 3 * max(len(self.attack_a), len(self.attack_b))
+        self.attack_lookahead = (
+            math.ceil(math.log(tolerance) / math.log(coef)) if coef < 1 else 0
+        )
+
+        self.hold_window = ms_to_samples(config.limiter.hold, config.internal_sample_rate)
+        self.hold_b, self.hold_a = signal.butter(
+            config.limiter.hold_filter_order,
+            config.limiter.hold_filter_coefficient,
+            fs=config.internal_sample_rate,
+        )
+        self.release_b, self.release_a = signal.butter(
+            config.limiter.release_filter_order,
+            config.limiter.release_filter_coefficient / config.limiter.release,
+            fs=config.internal_sample_rate,
+        )
+        self.hold_zi = np.zeros(max(len(self.hold_a), len(self.hold_b)) - 1)
+        self.release_zi = np.zeros(max(len(self.release_a), len(self.release_b)) - 1)
+
+        self.latency = self.attack_window - 1 + self.attack_lookahead
+
+        # Absolute sample positions: received >= slided >= emitted
+        self.received, self.slided, self.emitted = 0, 0, 0
+        # Audio and envelopes from self.emitted on, the hard clip gain from self.hard_clip_start on
+        self.audio = None
+        self.gain_hard_clip = np.zeros(0)
+        self.hard_clip_start = 0
+        self.gain_release = np.zeros(0)
+        self.attack_forward = np.zeros(0)
+        self.attack_forward_zi = None
+        # The last samples of the attack sliding max for the hold window and the end padding
+        self.slided_tail = np.zeros(0)
+
+    def process(self, block: np.ndarray) -> np.ndarray:
+        if self.audio is None:
+            self.audio = block[:0]
+        self.audio = np.concatenate((self.audio, block))
+        self.gain_hard_clip = np.concatenate(
+            (self.gain_hard_clip, flip(1.0 / rectify(block, self.config.threshold)))
+        )
+        self.received += len(block)
+        return self._advance(final=False)
+
+    def flush(self) -> np.ndarray:
+        if self.audio is None:
+            return np.zeros((0, 2))
+        result = self._advance(final=True)
+        if self.attack_forward_zi is None:
+            # Too short to start streaming, so nothing has been emitted yet
+            result = limit(self.audio, self.config)
+            self.audio = self.audio[:0]
+        return result
+
+    def _advance(self, final: bool) -> np.ndarray:
+        from scipy import signal
+        from scipy.ndimage import maximum_filter1d
+
+        # Attack sliding max: a centered window, so it needs attack_window - 1 samples ahead
+        window = self.attack_window - 1
+        slided_end = self.received if final else self.received - window
+        if slided_end > self.slided:
+            start = max(0, self.slided - window)
+            end = min(self.received, slided_end + window)
+            slided = maximum_filter1d(
+                self.gain_hard_clip[start - self.hard_clip_start : end - self.hard_clip_start],
+                size=2 * self.attack_window - 1,
+            )[self.slided - start : slided_end - start]
+            self._hold_release(slided)
+            self._attack_forward(slided)
+            self.slided = slided_end
+
+        # The zero-phase attack filter runs backwards from attack_lookahead samples ahead
+        if self.attack_forward_zi is None:
+            return self.audio[:0]
+        forward = self.attack_forward
+        if final:
+            tail = self.slided_tail
+            padding = 2 * tail[-1] - tail[-2 : -self.attack_padding - 2 : -1]
+            padded, _ = signal.lfilter(
+                self.attack_b, self.attack_a, padding, zi=self.attack_forward_zi
+            )
+            forward = np.concatenate((forward, padded))
+            ready = len(self.attack_forward)
+        else:
+            ready = len(forward) - self.attack_lookahead
+            if ready <= 0:
+                return self.audio[:0]
+        gain_attack, _ = signal.lfilter(
+            self.attack_b,
+            self.attack_a,
+            forward[::-1],
+            zi=self.attack_zi * forward[-1],
+        )
+        gain_attack = gain_attack[::-1][:ready]
+
+        hard_clip_offset = self.emitted - self.hard_clip_start
+        gain = flip(
+            max_mix(
+                self.gain_hard_clip[hard_clip_offset : hard_clip_offset + ready],
+                gain_attack,
+                self.gain_release[:ready],
+            )
+        )
+        result = self.audio[:ready] * gain.astype(self.audio.dtype, copy=False)[:, None]
+
+        self.emitted += ready
+        self.audio = self.audio[ready:]
+        self.gain_release = self.gain_release[ready:]
+        self.attack_forward = self.attack_forward[ready:]
+        hard_clip_start = min(self.emitted, max(0, self.slided - window))
+        self.gain_hard_clip = self.gain_hard_clip[hard_clip_start - self.hard_clip_start :]
+        self.hard_clip_start = hard_clip_start
+        return result
+
+    def _hold_release(self, slided: np.ndarray) -> None:
+        from scipy import signal
+        from scipy.ndimage import maximum_filter1d
+
+        # Hold sliding max: a trailing window continued from the previous samples
+        history = self.slided_tail[max(0, len(self.slided_tail) - self.hold_window + 1) :]
+        slided_hold = maximum_filter1d(
+            np.concatenate((history, slided)),
+            size=self.hold_window,
+            origin=(self.hold_window - 1) // 2,
+            mode="constant",
+        )[len(history) :]
+        self.slided_tail = np.concatenate((self.slided_tail, slided))[
+            -max(self.hold_window - 1, self.attack_padding + 1) :
+        ]
+
+        hold_output, self.hold_zi = signal.lfilter(
+            self.hold_b, self.hold_a, slided_hold, zi=self.hold_zi
+        )
+        release_output, self.release_zi = signal.lfilter(
+            self.release_b,
+            self.release_a,
+            np.maximum(slided_hold, hold_output),
+            zi=self.release_zi,
+        )
+        self.gain_release = np.concatenate(
+            (self.gain_release, np.maximum(hold_output, release_output))
+        )
+
+    def _attack_forward(self, slided: np.ndarray) -> None:
+        from scipy import signal
 
-    return array * gain[:, None]
+        if self.attack_forward_zi is None:
+            # Collect enough samples for the odd-mirrored start padding of filtfilt
+            self.attack_forward = np.concatenate((self.attack_forward, slided))
+            if len(self.attack_forward) <= self.attack_padding:
+                return
+            slided = self.attack_forward
+            padding = 2 * slided[0] - slided[self.attack_padding : 0 : -1]
+            _, self.attack_forward_zi = signal.lfilter(
+                self.attack_b, self.attack_a, padding, zi=self.attack_zi * padding[0]
+            )
+            self.attack_forward = np.zeros(0)
+        output, self.attack_forward_zi = signal.lfilter(
+            self.attack_b, self.attack_a, slided, zi=self.attack_forward_zi
+        )
+        self.attack_forward = np.concatenate((self.attack_forward, output))
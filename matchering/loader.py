@@ -19,25 +19,138 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
 import os
+import json
+import struct
 import numpy as np
 import soundfile as sf
 import subprocess
 
 from .log import Code, warning, info, debug, ModuleError
-from .utils import random_file
 
 
-def load(file: str, file_type: str, temp_folder: str) -> (np.ndarray, int):
+def __probe_with_ffprobe(file: str) -> (int, int, int):
+    # The number of frames (None if unknown), channels and the sample rate of the first audio stream
+    output = subprocess.check_output(
+        [
+            "ffprobe",
+            "-v",
+            "error",
+            "-select_streams",
+            "a:0",
+            "-show_entries",
+            "stream=channels,sample_rate,duration:format=duration",
+            "-of",
+            "json",
+            file,
+        ],
+        stderr=subprocess.DEVNULL,
+        text=True,
+    )
+    output = json.loads(output)
+    stream = output["streams"][0]
+    channels, sample_rate = int(stream["channels"]), int(stream["sample_rate"])
+    duration = stream.get("duration", output.get("format", {}).get("duration"))
+    try:
+        frames = round(float(duration) * sample_rate)
+    except (TypeError, ValueError):
+        frames = None
+    return frames, channels, sample_rate
+
+
+def probe(file: str, file_type: str, max_length: float = None) -> (str, int, int, int):
+    # Reads only the headers: returns the decoder ("soundfile" or "ffmpeg"), the number of frames
+    # (None if the container does not tell), the number of channels and the sample rate.
+    # Files that cannot be decoded, have more than two channels or are longer
+    # than max_length seconds are rejected before decoding
     file_type = file_type.upper()
-    sound, sample_rate = None, None
-    debug(f"Loading the {file_type} file: '{file}'...")
     try:
-        sound, sample_rate = sf.read(file, always_2d=True)
+        file_info = sf.info(file)
+        decoder = "soundfile"
+        frames, channels, sample_rate = (
+            file_info.frames,
+            file_info.channels,
+            file_info.samplerate,
+        )
     except RuntimeError as e:
         debug(e)
+        decoder, frames, channels, sample_rate = None, None, None, None
         e = str(e)
         if "unknown format" in e or "Format not recognised" in e:
-            sound, sample_rate = __load_with_ffmpeg(file, file_type, temp_folder)
+            try:
+                frames, channels, sample_rate = __probe_with_ffprobe(file)
+                decoder = "ffmpeg"
+            except FileNotFoundError:
+                debug(
+                    "ffprobe is not found in the system! "
+                    "Download, install and add it to PATH: https://www.ffmpeg.org/download.html"
+                )
+            except (subprocess.CalledProcessError, LookupError, ValueError):
+                debug(f"ffprobe cannot read the audio stream of '{file}'!")
+    if decoder is None or channels < 1 or sample_rate < 1:
+        raise ModuleError(
+            Code.ERROR_TARGET_LOADING
+            if file_type == "TARGET"
+            else Code.ERROR_REFERENCE_LOADING
+        )
+
+    debug(
+        f"{file_type} file header: {decoder}, {channels} channel(s), {sample_rate} Hz, "
+        f"{frames if frames is not None else 'unknown number of'} frames"
+    )
+    if channels > 2:
+        raise ModuleError(
+            Code.ERROR_TARGET_NUM_OF_CHANNELS_IS_EXCEEDED
+            if file_type == "TARGET"
+            else Code.ERROR_REFERENCE_NUM_OF_CHANNELS_IS_EXCEEDED
+        )
+    if max_length is not None and frames is not None and frames > max_length * sample_rate:
+        raise ModuleError(
+            Code.ERROR_TARGET_LENGTH_IS_EXCEEDED
+            if file_type == "TARGET"
+            else Code.ERROR_REFERENCE_LENGTH_LENGTH_IS_EXCEEDED
+        )
+    return decoder, frames, channels, sample_rate
+
+
+def load(
+    file: str,
+    file_type: str,
+    temp_folder: str,
+    memory_map: bool = False,
+    dtype="float64",
+    ffmpeg_sample_rate: int = None,
+    max_length: float = None,
+) -> (np.ndarray, int):
+    # ffmpeg_sample_rate: lets ffmpeg resample the files that only it can decode.
+    # temp_folder is kept for compatibility, ffmpeg decodes through a pipe now
+    file_type = file_type.upper()
+    sound, sample_rate = None, None
+    debug(f"Loading the {file_type} file: '{file}'...")
+    decoder, frames, channels, file_sample_rate = probe(file, file_type, max_length)
+
+    if frames is not None:
+        decoded_sample_rate = (
+            ffmpeg_sample_rate
+            if decoder == "ffmpeg" and ffmpeg_sample_rate
+            else file_sample_rate
+        )
+        decoded_size = (
+            frames * decoded_sample_rate / file_sample_rate * channels * np.dtype(dtype).itemsize
+        )
+        debug(f"The decoded {file_type} audio will take about {decoded_size / 2 ** 20:.1f} MiB")
+
+    try:
+        if decoder == "ffmpeg":
+            sound, sample_rate = __load_with_ffmpeg(
+                file, file_type, channels, file_sample_rate, ffmpeg_sample_rate, dtype
+            )
+        else:
+            if memory_map:
+                sound, sample_rate = __load_wav_low_memory(file, file_type, dtype)
+            if sound is None:
+                sound, sample_rate = sf.read(file, always_2d=True, dtype=dtype)
+    except RuntimeError as e:
+        debug(e)
     if sound is None or sample_rate is None:
         if file_type == "TARGET":
             raise ModuleError(Code.ERROR_TARGET_LOADING)
@@ -47,28 +160,123 @@ def load(file: str, file_type: str, temp_folder: str) -> (np.ndarray, int):
     return sound, sample_rate
 
 
+def __find_wav_data_chunk(file: str) -> (int, int):
+    with open(file, "rb") as f:
+        header = f.read(12)
+        if len(header) < 12:
+            return None, None
+        riff, _, wave = struct.unpack("<4sI4s", header)
+        if riff != b"RIFF" or wave != b"WAVE":
+            return None, None
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                return None, None
+            chunk_id, chunk_size = struct.unpack("<4sI", header)
+            if chunk_id == b"data":
+                return f.tell(), chunk_size
+            # Chunks are word-aligned
+            f.seek(chunk_size + (chunk_size & 1), os.SEEK_CUR)
+
+
+def __load_wav_low_memory(file: str, file_type: str, dtype) -> (np.ndarray, int):
+    try:
+        file_info = sf.info(file)
+    except RuntimeError:
+        return None, None
+    if file_info.format != "WAV":
+        return None, None
+
+    stored_dtype = {"FLOAT": "<f4", "DOUBLE": "<f8"}.get(file_info.subtype)
+    if stored_dtype is None or np.dtype(stored_dtype) != np.dtype(dtype):
+        # Integer PCM has to be scaled and other floats converted,
+        # so they are read right in the processing dtype instead
+        debug(f"The {file_type} {file_info.subtype} samples cannot be mapped as {np.dtype(dtype)}")
+        return None, None
+    dtype = stored_dtype
+
+    offset, data_size = __find_wav_data_chunk(file)
+    shape = (file_info.frames, file_info.channels)
+    if offset is None or data_size < shape[0] * shape[1] * np.dtype(dtype).itemsize:
+        return None, None
+
+    # The samples are already normalized floats, so they can be used right from the page cache
+    debug(f"Mapping the {file_type} {file_info.subtype} samples to memory...")
+    sound = np.memmap(file, dtype=dtype, mode="r", offset=offset, shape=shape)
+    return sound, file_info.samplerate
+
+
+def __decode_with_ffmpeg(
+    file: str, channels: int, sample_rate: int = None, dtype="float64"
+) -> np.ndarray:
+    # ffmpeg writes raw float32 PCM to stdout, so no temporary file is needed.
+    # The samples are converted block by block while ffmpeg keeps decoding
+    command = ["ffmpeg", "-v", "error", "-nostdin", "-i", file, "-map", "0:a:0"]
+    if sample_rate is not None:
+        command += ["-ar", str(sample_rate)]
+    command += ["-f", "f32le", "-acodec", "pcm_f32le", "-"]
+
+    frame_size = channels * 4
+    block_size = 65536 * frame_size
+    blocks, remainder = [], b""
+    with subprocess.Popen(
+        command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+    ) as process:
+        try:
+            while True:
+                data = process.stdout.read(block_size)
+                if not data:
+                    break
+                data = remainder + data
+                usable = len(data) - len(data) % frame_size
+                blocks.append(
+                    np.frombuffer(data[:usable], dtype="<f4")
+                    .reshape(-1, channels)
+                    .astype(dtype)
+                )
+                remainder = data[usable:]
+        except BaseException:
+            process.kill()
+            raise
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, command)
+    if not blocks:
+        return np.zeros((0, channels), dtype=dtype)
+    return np.concatenate(blocks)
+
+
 def __load_with_ffmpeg(
-    file: str, file_type: str, temp_folder: str
+    file: str,
+    file_type: str,
+    channels: int,
+    file_sample_rate: int,
+    sample_rate: int = None,
+    dtype="float64",
 ) -> (np.ndarray, int):
-    sound, sample_rate = None, None
+    sound = None
     debug(f"Trying to load '{file}' with ffmpeg...")
-    temp_file = os.path.join(temp_folder, random_file(prefix="temp"))
-    with open(os.devnull, "w") as devnull:
-        try:
-            subprocess.check_call(
-                ["ffmpeg", "-i", file, temp_file], stdout=devnull, stderr=devnull
-            )
-            sound, sample_rate = sf.read(temp_file, always_2d=True)
-            if file_type == "TARGET":
-                warning(Code.WARNING_TARGET_IS_LOSSY)
-            else:
-                info(Code.INFO_REFERENCE_IS_LOSSY)
-            os.remove(temp_file)
-        except FileNotFoundError:
-            debug(
-                "ffmpeg is not found in the system! "
-                "Download, install and add it to PATH: https://www.ffmpeg.org/download.html"
-            )
-        except subprocess.CalledProcessError:
-            debug(f"ffmpeg cannot convert '{file}' to .wav!")
-    return sound, sample_rate
+    if sample_rate is None or sample_rate == file_sample_rate:
+        sample_rate = None
+    else:
+        debug(
+            f"Resampling {file_type} audio from {file_sample_rate} Hz "
+            f"to {sample_rate} Hz with ffmpeg..."
+        )
+    try:
+        sound = __decode_with_ffmpeg(file, channels, sample_rate, dtype)
+        if file_type == "TARGET":
+            warning(Code.WARNING_TARGET_IS_LOSSY)
+            if sample_rate is not None:
+                warning(Code.WARNING_TARGET_IS_RESAMPLED)
+        else:
+            info(Code.INFO_REFERENCE_IS_LOSSY)
+            if sample_rate is not None:
+                info(Code.INFO_REFERENCE_IS_RESAMPLED)
+    except FileNotFoundError:
+        debug(
+            "ffmpeg is not found in the system! "
+            "Download, install and add it to PATH: https://www.ffmpeg.org/download.html"
+        )
+    except subprocess.CalledProcessError:
+        debug(f"ffmpeg cannot decode '{file}'!")
+    return sound, sample_rate or file_sample_rate
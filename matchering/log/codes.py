@@ -48,11 +48,13 @@ class Code(IntEnum):
     ERROR_TARGET_LENGTH_IS_TOO_SMALL = 4003
     ERROR_TARGET_NUM_OF_CHANNELS_IS_EXCEEDED = 4004
     ERROR_TARGET_EQUALS_REFERENCE = 4005
+    ERROR_TARGET_PROFILE_IS_INCOMPATIBLE = 4006
 
     ERROR_REFERENCE_LOADING = 4101
     ERROR_REFERENCE_LENGTH_LENGTH_IS_EXCEEDED = 4102
     ERROR_REFERENCE_LENGTH_LENGTH_TOO_SMALL = 4103
     ERROR_REFERENCE_NUM_OF_CHANNELS_IS_EXCEEDED = 4104
+    ERROR_REFERENCE_PROFILE_IS_INCOMPATIBLE = 4105
 
     ERROR_UNKNOWN = 4201
     ERROR_VALIDATION = 4202
@@ -25,3 +25,8 @@ from .codes import Code
 class ModuleError(Exception):
     def __init__(self, code: Code):
         Exception.__init__(self, get_explanation_handler(show_codes=True)(code))
+        self.code = code
+
+    def __reduce__(self):
+        # Lets the error cross process boundaries
+        return self.__class__, (self.code,)
@@ -19,52 +19,44 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
 import numpy as np
+import soundfile as sf
 
 from .log import Code, info, debug, debug_line
-from .dsp import size, strided_app_2d, batch_rms_2d, fade, clip
+from .dsp import size, loudest_window, fade, clip, is_mono, mono_to_stereo
 from . import Config, Result
+from .loader import probe, load
 from .saver import save
+from .resampler import QUALITY_TIERS, get_filter, get_ratio, resample
 from .utils import time_str
 
 
-def create_preview(
-    target: np.ndarray,
-    result: np.ndarray,
-    config: Config,
-    preview_target: Result,
-    preview_result: Result,
-) -> None:
-    debug_line()
-    info(Code.INFO_MAKING_PREVIEWS)
-
-    target = clip(target, config.threshold)
-
+def get_preview_window(result: np.ndarray, config: Config) -> (int, int):
+    # The first and the last + 1 sample of the loudest part of the RESULT
     debug(
         f"The maximum duration of the preview is {config.preview_size / config.internal_sample_rate} seconds, "
         f"with the analysis step of {config.preview_analysis_step / config.internal_sample_rate} seconds"
     )
-
-    target_pieces = strided_app_2d(
-        target, config.preview_size, config.preview_analysis_step
-    )
-    result_pieces = strided_app_2d(
+    start = config.preview_analysis_step * loudest_window(
         result, config.preview_size, config.preview_analysis_step
     )
-
-    result_loudest_piece_idx = np.argmax(batch_rms_2d(result_pieces))
-
-    target_piece = target_pieces[result_loudest_piece_idx].copy()
-    result_piece = result_pieces[result_loudest_piece_idx].copy()
-
-    del target, target_pieces, result_pieces
-
-    debug_sample_begin = config.preview_analysis_step * int(result_loudest_piece_idx)
-    debug_sample_end = debug_sample_begin + size(result_piece)
+    end = min(start + config.preview_size, size(result))
     debug(
         f"The best part to preview: "
-        f"{time_str(debug_sample_begin, config.internal_sample_rate)} "
-        f"- {time_str(debug_sample_end, config.internal_sample_rate)}"
+        f"{time_str(start, config.internal_sample_rate)} "
+        f"- {time_str(end, config.internal_sample_rate)}"
     )
+    return start, end
+
+
+def create_preview_pieces(
+    target: np.ndarray, result: np.ndarray, config: Config, window: (int, int) = None
+) -> (np.ndarray, np.ndarray):
+    debug_line()
+    info(Code.INFO_MAKING_PREVIEWS)
+
+    start, end = window if window else get_preview_window(result, config)
+    target_piece = clip(target[start:end], config.threshold)
+    result_piece = result[start:end].copy()
 
     if size(result) != size(result_piece):
         fade_size = min(
@@ -81,20 +73,90 @@ def create_preview(
             return piece
         return piece * (config.threshold / peak)
 
+    return normalize_piece(target_piece), normalize_piece(result_piece)
+
+
+def read_preview_piece(
+    file: str,
+    window: (int, int),
+    sample_rate: int,
+    resampling_quality: str = "high",
+    dtype="float64",
+    file_type: str = "target",
+) -> np.ndarray:
+    # Reads only the window (start, end), given in samples at sample_rate, from an audio file.
+    # A file at another sample rate is read with some margin and only that part is resampled,
+    # the result is the same as cutting the window from the whole resampled file
+    start, end = window
+    decoder, frames, _, file_sample_rate = probe(file, file_type)
+    if decoder == "ffmpeg":
+        # libsndfile cannot open the file, so ffmpeg decodes it in full and it is cut in memory
+        array, _ = load(file, file_type, None, dtype=dtype)
+        frames = size(array)
+
+        def read(read_start: int, read_end: int) -> np.ndarray:
+            return array[read_start:read_end]
+
+    else:
+
+        def read(read_start: int, read_end: int) -> np.ndarray:
+            piece, _ = sf.read(
+                file, start=read_start, stop=read_end, always_2d=True, dtype=dtype
+            )
+            return piece
+
+    if file_sample_rate == sample_rate:
+        piece = read(start, end)
+    else:
+        up, down = get_ratio(file_sample_rate, sample_rate)
+        # The filter support in the samples of the file, plus the polyphase alignment
+        margin = (
+            len(get_filter(up, down, resampling_quality)) // (2 * up)
+            if resampling_quality in QUALITY_TIERS
+            else 4096
+        ) + down
+        # The piece starts at a multiple of down, so its output samples fall on the global grid
+        file_start = max(0, start * down // up - margin)
+        file_start -= file_start % down
+        file_end = min(frames, -(-end * down // up) + margin)
+        piece = read(file_start, file_end)
+        debug(
+            f"Resampling the preview of '{file}' from {file_sample_rate} Hz to {sample_rate} Hz..."
+        )
+        offset = start - file_start * up // down
+        piece = resample(piece, file_sample_rate, sample_rate, resampling_quality)[
+            offset : offset + end - start
+        ]
+    if is_mono(piece):
+        piece = mono_to_stereo(piece)
+    return piece
+
+
+def create_preview(
+    target: np.ndarray,
+    result: np.ndarray,
+    config: Config,
+    preview_target: Result,
+    preview_result: Result,
+) -> None:
+    target_piece, result_piece = create_preview_pieces(target, result, config)
+
     if preview_target:
         save(
             preview_target.file,
-            normalize_piece(target_piece),
+            target_piece,
             config.internal_sample_rate,
             preview_target.subtype,
             "target preview",
+            preview_target.format,
         )
 
     if preview_result:
         save(
             preview_result.file,
-            normalize_piece(result_piece),
+            result_piece,
             config.internal_sample_rate,
             preview_result.subtype,
             "result preview",
+            preview_result.format,
         )
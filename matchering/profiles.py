@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+
+"""
+Matchering - Audio Matching and Mastering Python Library
+Copyright (C) 2016-2022 Sergree
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import numpy as np
+
+
+class ReferenceProfile:
+    # Bump this when the stored fields or their meaning change
+    version = 1
+
+    def __init__(
+        self,
+        match_rms: float,
+        final_amplitude_coefficient: float,
+        mid_fft: np.ndarray,
+        side_fft: np.ndarray,
+        sample_rate: int,
+        fft_size: int,
+        max_piece_size: float,
+        threshold: float,
+    ):
+        assert match_rms >= 0
+        self.match_rms = float(match_rms)
+
+        assert final_amplitude_coefficient > 0
+        self.final_amplitude_coefficient = float(final_amplitude_coefficient)
+
+        assert mid_fft.shape == side_fft.shape == (fft_size // 2 + 1,)
+        self.mid_fft = mid_fft
+        self.side_fft = side_fft
+
+        self.sample_rate = int(sample_rate)
+        self.fft_size = int(fft_size)
+        self.max_piece_size = float(max_piece_size)
+        self.threshold = float(threshold)
+
+    def save(self, file) -> None:
+        # Passing an open file prevents numpy from appending ".npz" to the name
+        if isinstance(file, str):
+            with open(file, "wb") as f:
+                return self.save(f)
+        np.savez(
+            file,
+            version=self.version,
+            match_rms=self.match_rms,
+            final_amplitude_coefficient=self.final_amplitude_coefficient,
+            mid_fft=self.mid_fft,
+            side_fft=self.side_fft,
+            sample_rate=self.sample_rate,
+            fft_size=self.fft_size,
+            max_piece_size=self.max_piece_size,
+            threshold=self.threshold,
+        )
+
+    @classmethod
+    def load(cls, file) -> "ReferenceProfile":
+        with np.load(file, allow_pickle=False) as data:
+            version = int(data["version"])
+            if version != cls.version:
+                raise TypeError(
+                    f"Reference profile version {version} is not supported, "
+                    f"expected {cls.version}"
+                )
+            return cls(
+                match_rms=float(data["match_rms"]),
+                final_amplitude_coefficient=float(data["final_amplitude_coefficient"]),
+                mid_fft=data["mid_fft"],
+                side_fft=data["side_fft"],
+                sample_rate=int(data["sample_rate"]),
+                fft_size=int(data["fft_size"]),
+                max_piece_size=float(data["max_piece_size"]),
+                threshold=float(data["threshold"]),
+            )
+
+
+class TargetProfile:
+    def __init__(
+        self,
+        array: np.ndarray,
+        match_rms: float,
+        divisions: int,
+        piece_size: int,
+        mid_fft: np.ndarray,
+        side_fft: np.ndarray,
+        sample_rate: int,
+        fft_size: int,
+        max_piece_size: float,
+    ):
+        # The checked stereo TARGET audio, the mid and side channels are recalculated from it on demand
+        self.array = array
+
+        assert match_rms >= 0
+        self.match_rms = float(match_rms)
+
+        assert divisions > 0
+        assert piece_size > 0
+        self.divisions = int(divisions)
+        self.piece_size = int(piece_size)
+
+        # The average spectra of the loudest pieces before any level matching
+        assert mid_fft.shape == side_fft.shape == (fft_size // 2 + 1,)
+        self.mid_fft = mid_fft
+        self.side_fft = side_fft
+
+        self.sample_rate = int(sample_rate)
+        self.fft_size = int(fft_size)
+        self.max_piece_size = float(max_piece_size)
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+"""
+Matchering - Audio Matching and Mastering Python Library
+Copyright (C) 2016-2022 Sergree
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import math
+import numpy as np
+from functools import lru_cache
+
+from .log import debug
+
+# Polyphase low-pass filters: (zero crossings per side, Kaiser beta, cutoff relative to the lower Nyquist)
+# "fast" and "best" follow the kaiser_fast and kaiser_best filters of resampy
+QUALITY_TIERS = {
+    "fast": (16, 8.555, 0.85),
+    "high": (32, 10.0, 0.94),
+    "best": (64, 14.77, 0.9476),
+}
+# The previous whole-signal path: resampy if it is installed, else the FFT resampling of SciPy
+LEGACY_QUALITY = "legacy"
+QUALITIES = (*QUALITY_TIERS, LEGACY_QUALITY)
+
+
+def get_ratio(sample_rate: int, new_sample_rate: int) -> (int, int):
+    divisor = math.gcd(int(sample_rate), int(new_sample_rate))
+    return int(new_sample_rate) // divisor, int(sample_rate) // divisor
+
+
+@lru_cache(maxsize=16)
+def get_filter(up: int, down: int, quality: str) -> np.ndarray:
+    from scipy.signal import firwin
+
+    zero_crossings, beta, rolloff = QUALITY_TIERS[quality]
+    max_rate = max(up, down)
+    half_size = int(zero_crossings * max_rate / rolloff)
+    fir = firwin(2 * half_size + 1, rolloff / max_rate, window=("kaiser", beta))
+    fir.flags.writeable = False
+    return fir
+
+
+def __resample_legacy(
+    array: np.ndarray, sample_rate: int, new_sample_rate: int
+) -> np.ndarray:
+    # The resamplers are heavy imports, so they are only loaded when needed
+    try:
+        from resampy import resample
+
+        return resample(array, sample_rate, new_sample_rate, axis=0)
+    except ImportError:
+        # Fallback to scipy for Python 3.14+ compatibility
+        from scipy.signal import resample as scipy_resample
+
+        num_samples = int(array.shape[0] * new_sample_rate / sample_rate)
+        return scipy_resample(array, num_samples, axis=0)
+
+
+def resample(
+    array: np.ndarray, sample_rate: int, new_sample_rate: int, quality: str = "high"
+) -> np.ndarray:
+    # (samples,) or (samples, channels) -> the same at new_sample_rate
+    assert quality in QUALITIES
+    if quality == LEGACY_QUALITY:
+        return __resample_legacy(array, sample_rate, new_sample_rate)
+
+    from scipy.signal import resample_poly
+
+    up, down = get_ratio(sample_rate, new_sample_rate)
+    if up == down:
+        return np.copy(array)
+    debug(f"Using the {quality} quality polyphase resampler with the ratio {up}/{down}")
+    result = resample_poly(array, up, down, axis=0, window=get_filter(up, down, quality))
+    return result.astype(array.dtype, copy=False)
+
+
+class StreamingResampler:
+    # Block-by-block version of resample(): feed the audio with process() and finish with flush().
+    # The concatenated output is identical to resample() of the whole signal
+    def __init__(self, sample_rate: int, new_sample_rate: int, quality: str = "high"):
+        assert quality in QUALITY_TIERS
+        self.up, self.down = get_ratio(sample_rate, new_sample_rate)
+
+        # The same zero-padded filter and output alignment as in scipy.signal.resample_poly
+        fir = get_filter(self.up, self.down, quality)
+        half_size = (len(fir) - 1) // 2
+        pre_padding = self.down - half_size % self.down
+        self.fir = np.concatenate((np.zeros(pre_padding), fir * self.up))
+        self.delay = (half_size + pre_padding) // self.down
+
+        # Absolute positions: the buffer holds the input from self.start on,
+        # self.start is always a multiple of self.down to keep the polyphase alignment
+        self.buffer = None
+        self.start, self.received, self.emitted = 0, 0, 0
+
+    def process(self, block: np.ndarray) -> np.ndarray:
+        if self.buffer is None:
+            self.buffer = block[:0]
+        self.buffer = np.concatenate((self.buffer, block))
+        self.received += len(block)
+        # The last output that only depends on the received input
+        end = (self.received - 1) * self.up // self.down + 1 - self.delay
+        return self._emit(self.buffer, end)
+
+    def flush(self) -> np.ndarray:
+        if self.buffer is None:
+            return np.zeros(0)
+        end = -(-self.received * self.up // self.down)
+        # The input is zero after its end, the filter tail still adds to the last outputs
+        padding = np.zeros((len(self.fir) // self.up + 1, *self.buffer.shape[1:]))
+        return self._emit(np.concatenate((self.buffer, padding)), end)
+
+    def _emit(self, buffer: np.ndarray, end: int) -> np.ndarray:
+        from scipy.signal import upfirdn
+
+        if end <= self.emitted:
+            return self.buffer[:0]
+        offset = self.start * self.up // self.down - self.delay
+        result = upfirdn(self.fir, buffer, self.up, self.down, axis=0)[
+            self.emitted - offset : end - offset
+        ]
+        self.emitted = end
+
+        # Keep the input that the next outputs still need
+        first = max(
+            0, -(-((end + self.delay) * self.down - len(self.fir) + 1) // self.up)
+        )
+        start = first - first % self.down
+        self.buffer = self.buffer[start - self.start :]
+        self.start = start
+        return result.astype(self.buffer.dtype, copy=False)
@@ -20,23 +20,55 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import os
 import soundfile as sf
+from .defaults import LimiterConfig
 
 
 class Result:
     def __init__(
-        self, file: str, subtype: str, use_limiter: bool = True, normalize: bool = True
+        self,
+        file: str,
+        subtype: str,
+        use_limiter: bool = True,
+        normalize: bool = True,
+        limiter: LimiterConfig = None,
+        threshold: float = None,
+        format: str = None,
+        ceiling: float = None,
     ):
-        _, file_ext = os.path.splitext(file)
-        file_ext = file_ext[1:].upper()
+        # file: a path, or a writable binary file object such as io.BytesIO.
+        # format: taken from the file extension by default, "WAV" for file objects
+        if format is None:
+            if isinstance(file, (str, os.PathLike)):
+                _, file_ext = os.path.splitext(file)
+                format = file_ext[1:]
+            else:
+                format = "WAV"
+        file_ext = format.upper()
         if not sf.check_format(file_ext):
             raise TypeError(f"{file_ext} format is not supported")
         if not sf.check_format(file_ext, subtype):
             raise TypeError(f"{file_ext} format does not have {subtype} subtype")
         self.file = file
+        self.format = file_ext
         self.subtype = subtype
         self.use_limiter = use_limiter
         self.normalize = normalize
 
+        # Limiter variant: overrides Config.limiter and Config.threshold for this result only.
+        # Results sharing the same variant are limited once. The variants share the pre-limiter audio,
+        # unless their threshold normalizes the REFERENCE differently (it peaks below the threshold),
+        # then they are matched separately. With a REFERENCE profile, the threshold only changes the limiter
+        assert limiter is None or isinstance(limiter, LimiterConfig)
+        assert threshold is None or 0 < threshold < 1
+        assert use_limiter or (limiter is None and threshold is None)
+        self.limiter = limiter
+        self.threshold = threshold
+
+        # Post-limiter ceiling: overrides Config.post_limiter_ceiling for this result only
+        assert ceiling is None or 0 < ceiling <= 1
+        assert use_limiter or ceiling is None
+        self.ceiling = ceiling
+
 
 def pcm16(file: str) -> Result:
     return Result(file, "PCM_16")
@@ -18,16 +18,65 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
+import io
+import os
 import numpy as np
 import soundfile as sf
+from concurrent.futures import ThreadPoolExecutor
 
 from .log import debug
 
 
 def save(
-    file: str, result: np.ndarray, sample_rate: int, subtype: str, name: str = "result"
+    file,
+    result: np.ndarray,
+    sample_rate: int,
+    subtype: str,
+    name: str = "result",
+    format: str = None,
 ) -> None:
+    # file: a path, or a writable binary file object together with format
     name = name.upper()
     debug(f"Saving the {name} {sample_rate} Hz Stereo {subtype} to: '{file}'...")
-    sf.write(file, result, sample_rate, subtype)
+    sf.write(file, result, sample_rate, subtype, format=format)
     debug(f"'{file}' is saved")
+
+
+def __save_group(outputs: list, sample_rate: int) -> None:
+    file, result, subtype, format, name = outputs[0]
+    if len(outputs) == 1:
+        save(file, result, sample_rate, subtype, name, format)
+        return
+
+    # The same audio in the same format: quantize and encode it once, then copy the bytes
+    encoded = io.BytesIO()
+    save(encoded, result, sample_rate, subtype, name, format)
+    for file, *_ in outputs:
+        if isinstance(file, (str, os.PathLike)):
+            with open(file, "wb") as f:
+                f.write(encoded.getbuffer())
+        else:
+            file.write(encoded.getbuffer())
+        debug(f"'{file}' is saved")
+
+
+def save_many(outputs: list, sample_rate: int, workers: int = None) -> None:
+    # outputs: (file, result, subtype, format, name) tuples.
+    # Outputs of the same array, subtype and format are encoded once, the others are written
+    # concurrently, as libsndfile releases the GIL while it converts and writes the samples
+    groups = {}
+    for output in outputs:
+        _, result, subtype, format, _ = output
+        groups.setdefault((id(result), subtype, format), []).append(output)
+    groups = list(groups.values())
+
+    workers = workers or min(len(groups), os.cpu_count() or 1)
+    if workers <= 1 or len(groups) <= 1:
+        for group in groups:
+            __save_group(group, sample_rate)
+        return
+
+    debug(f"Saving {len(outputs)} files in {len(groups)} groups with {workers} threads...")
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # list() re-raises the first failed write
+        list(executor.map(lambda group: __save_group(group, sample_rate), groups))
@@ -16,6 +16,7 @@ from .match_levels import (
     analyze_levels,
     get_average_rms,
     get_lpis_and_match_rms,
-    get_rms_c_and_amplify_pair,
+    calculate_rms_coefficient,
+    get_rms_correction_gain,
 )
-from .match_frequencies import get_fir, convolve
+from .match_frequencies import get_average_fft, get_fir, convolve
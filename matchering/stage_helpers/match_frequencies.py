@@ -20,21 +20,20 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import numpy as np
 from time import time
-from scipy import signal, interpolate
 
 from ..log import debug
 from .. import Config
-from ..dsp import ms_to_lr, smooth_lowess
+from ..dsp import size, ms_to_lr, smooth_lowess, convolve_stream
 
 
-def __average_fft(
-    loudest_pieces: np.ndarray, sample_rate: int, fft_size: int
-) -> np.ndarray:
+def get_average_fft(loudest_pieces: np.ndarray, config: Config) -> np.ndarray:
+    from scipy import signal
+
     *_, specs = signal.stft(
         loudest_pieces,
-        sample_rate,
+        config.internal_sample_rate,
         window="boxcar",
-        nperseg=fft_size,
+        nperseg=config.fft_size,
         noverlap=0,
         boundary=None,
         padded=False,
@@ -43,6 +42,8 @@ def __average_fft(
 
 
 def __smooth_exponentially(matching_fft: np.ndarray, config: Config) -> np.ndarray:
+    from scipy import interpolate
+
     grid_linear = (
         config.internal_sample_rate * 0.5 * np.linspace(0, 1, config.fft_size // 2 + 1)
     )
@@ -61,7 +62,11 @@ def __smooth_exponentially(matching_fft: np.ndarray, config: Config) -> np.ndarr
     matching_fft_log = interpolator(grid_logarithmic)
 
     matching_fft_log_filtered = smooth_lowess(
-        matching_fft_log, config.lowess_frac, config.lowess_it, config.lowess_delta
+        matching_fft_log,
+        config.lowess_frac,
+        config.lowess_it,
+        config.lowess_delta,
+        config.lowess_engine,
     )
 
     interpolator = interpolate.interp1d(
@@ -76,21 +81,18 @@ def __smooth_exponentially(matching_fft: np.ndarray, config: Config) -> np.ndarr
 
 
 def get_fir(
-    target_loudest_pieces: np.ndarray,
-    reference_loudest_pieces: np.ndarray,
+    target_average_fft: np.ndarray,
+    reference_average_fft: np.ndarray,
     name: str,
     config: Config,
 ) -> np.ndarray:
+    from scipy import signal
+
     debug(f"Calculating the {name} FIR for the matching EQ...")
 
-    target_average_fft = __average_fft(
-        target_loudest_pieces, config.internal_sample_rate, config.fft_size
-    )
-    reference_average_fft = __average_fft(
-        reference_loudest_pieces, config.internal_sample_rate, config.fft_size
+    target_average_fft = np.maximum(
+        config.min_value, target_average_fft, dtype=np.float64
     )
-
-    np.maximum(config.min_value, target_average_fft, out=target_average_fft)
     matching_fft = reference_average_fft / target_average_fft
 
     matching_fft_filtered = __smooth_exponentially(matching_fft, config)
@@ -101,14 +103,59 @@ def get_fir(
     return fir
 
 
+def __convolve_blocks(
+    target_mid: np.ndarray,
+    mid_fir: np.ndarray,
+    target_side: np.ndarray,
+    side_fir: np.ndarray,
+    block_size: int,
+) -> (np.ndarray, np.ndarray):
+    def blocks(array: np.ndarray):
+        for start in range(0, size(array), block_size):
+            yield array[start : start + block_size]
+
+    result = np.empty((size(target_mid), 2), dtype=target_mid.dtype)
+    result_mid = np.empty(size(target_mid), dtype=target_mid.dtype)
+
+    # Both FIRs have the same length, so the streams produce blocks of the same size
+    position = 0
+    for result_mid_block, result_side_block in zip(
+        convolve_stream(blocks(target_mid), mid_fir, block_size),
+        convolve_stream(blocks(target_side), side_fir, block_size),
+    ):
+        end = position + size(result_mid_block)
+        result_mid[position:end] = result_mid_block
+        np.add(result_mid_block, result_side_block, out=result[position:end, 0])
+        np.subtract(result_mid_block, result_side_block, out=result[position:end, 1])
+        position = end
+
+    return result, result_mid
+
+
 def convolve(
     target_mid: np.ndarray,
     mid_fir: np.ndarray,
     target_side: np.ndarray,
     side_fir: np.ndarray,
+    block_size: int = None,
 ) -> (np.ndarray, np.ndarray):
     debug("Convolving the TARGET audio with calculated FIRs...")
     timer = time()
+
+    # The FIRs are designed in float64, the audio keeps its own precision
+    mid_fir = mid_fir.astype(target_mid.dtype, copy=False)
+    side_fir = side_fir.astype(target_side.dtype, copy=False)
+
+    if block_size:
+        debug(f"Using the overlap-add convolution with the block size of {block_size}")
+        result, result_mid = __convolve_blocks(
+            target_mid, mid_fir, target_side, side_fir, block_size
+        )
+        debug(f"The convolution is done in {time() - timer:.2f} seconds")
+        return result, result_mid
+
+    from scipy import signal
+
     result_mid = signal.fftconvolve(target_mid, mid_fir, "same")
     result_side = signal.fftconvolve(target_side, side_fir, "same")
     debug(f"The convolution is done in {time() - timer:.2f} seconds")
@@ -23,7 +23,7 @@ import numpy as np
 from ..log import debug
 from .. import Config
 from ..utils import to_db
-from ..dsp import lr_to_ms, size, unfold, batch_rms, rms, amplify, normalize
+from ..dsp import lr_to_ms, lr_to_mid, size, unfold, batch_rms, rms, normalize
 
 
 def normalize_reference(reference: np.ndarray, config: Config) -> (np.ndarray, float):
@@ -71,25 +71,6 @@ def get_lpis_and_match_rms(
     return loudest_piece_idxs, match_rms
 
 
-def __extract_loudest_pieces(
-    rmses: np.ndarray,
-    average_rms: float,
-    unfolded_mid: np.ndarray,
-    unfolded_side: np.ndarray,
-    name: str,
-) -> (np.ndarray, np.ndarray, float):
-    debug(
-        f"Extracting the loudest pieces of the {name} audio "
-        f"with the RMS value more than average {to_db(average_rms)}..."
-    )
-    loudest_piece_idxs, match_rms = get_lpis_and_match_rms(rmses, average_rms)
-
-    mid_loudest_pieces = unfolded_mid[loudest_piece_idxs]
-    side_loudest_pieces = unfolded_side[loudest_piece_idxs]
-
-    return mid_loudest_pieces, side_loudest_pieces, match_rms
-
-
 def get_average_rms(
     array: np.ndarray, piece_size: int, divisions: int, name: str
 ) -> (np.ndarray, np.ndarray, float):
@@ -103,7 +84,7 @@ def get_average_rms(
     return unfolded_array, rmses, average_rms
 
 
-def __calculate_rms_coefficient(
+def calculate_rms_coefficient(
     array_match_rms: float, reference_match_rms: float, epsilon: float
 ) -> float:
     rms_coefficient = reference_match_rms / max(epsilon, array_match_rms)
@@ -111,48 +92,121 @@ def __calculate_rms_coefficient(
     return rms_coefficient
 
 
-def get_rms_c_and_amplify_pair(
-    array_main: np.ndarray,
-    array_additional: np.ndarray,
-    array_main_match_rms: float,
+def __extract_hot_samples(
+    unfolded_mid: np.ndarray, threshold: float, piece_sums: np.ndarray
+) -> (np.ndarray, np.ndarray, np.ndarray):
+    # Only the samples above the threshold can be clipped at the gains up to 1 / threshold,
+    # the rest of every piece is represented by its sum of squares
+    hot_pieces, hot_positions = np.nonzero(np.abs(unfolded_mid) > threshold)
+    hot_samples = unfolded_mid[hot_pieces, hot_positions].astype(np.float64)
+    cold_sums = piece_sums - np.bincount(
+        hot_pieces, hot_samples * hot_samples, len(piece_sums)
+    )
+    debug(f"{len(hot_samples)} samples of the RESULT mid channel can be clipped")
+    return cold_sums, hot_samples, hot_pieces
+
+
+def __clipped_match_rms(
+    cold_sums: np.ndarray,
+    hot_samples: np.ndarray,
+    hot_pieces: np.ndarray,
+    gain: float,
+    piece_size: int,
+) -> float:
+    # The same as get_average_rms() and get_lpis_and_match_rms() of clip(gain * mid)
+    hot_squares = np.minimum(np.square(gain * hot_samples), 1.0)
+    sums = gain * gain * cold_sums + np.bincount(hot_pieces, hot_squares, len(cold_sums))
+    rmses = np.sqrt(sums / piece_size)
+    _, match_rms = get_lpis_and_match_rms(rmses, rms(rmses))
+    return match_rms
+
+
+def get_rms_correction_gain(
+    mid: np.ndarray,
+    piece_size: int,
+    divisions: int,
     reference_match_rms: float,
-    epsilon: float,
-    name: str,
-) -> (float, np.ndarray, np.ndarray):
-    name = name.upper()
-    rms_coefficient = __calculate_rms_coefficient(
-        array_main_match_rms, reference_match_rms, epsilon
+    config: Config,
+) -> float:
+    # Solves for the gain that brings the clipped mid channel to the REFERENCE level
+    # on the piece statistics, so the audio itself is read twice and never rewritten
+    unfolded_mid = unfold(mid, piece_size, divisions)
+    debug("Calculating the piece statistics of the RESULT...")
+    piece_sums = np.einsum("ij,ij->i", unfolded_mid, unfolded_mid, dtype=np.float64)
+
+    # Clipping only lowers the RMS, so the gain without clipping is a good lower estimate.
+    # Some headroom above it saves extracting the clippable samples again
+    headroom = 1.25
+    rmses = np.sqrt(piece_sums / piece_size)
+    _, match_rms = get_lpis_and_match_rms(rmses, rms(rmses))
+    max_gain = headroom * max(
+        1.0, calculate_rms_coefficient(match_rms, reference_match_rms, config.min_value)
+    )
+    cold_sums, hot_samples, hot_pieces = __extract_hot_samples(
+        unfolded_mid, 1 / max_gain, piece_sums
     )
 
-    debug(f"Modifying the amplitudes of the {name} audio...")
-    array_main = amplify(array_main, rms_coefficient)
-    array_additional = amplify(array_additional, rms_coefficient)
+    gain = 1.0
+    for step in range(1, config.rms_correction_steps + 1):
+        debug(f"Applying RMS correction #{step}...")
+        if gain > max_gain:
+            max_gain = headroom * gain
+            cold_sums, hot_samples, hot_pieces = __extract_hot_samples(
+                unfolded_mid, 1 / max_gain, piece_sums
+            )
+        match_rms = __clipped_match_rms(
+            cold_sums, hot_samples, hot_pieces, gain, piece_size
+        )
+        rms_coefficient = calculate_rms_coefficient(
+            match_rms, reference_match_rms, config.min_value
+        )
+        gain *= rms_coefficient
+        if np.isclose(rms_coefficient, 1.0):
+            debug(f"The RMS correction has converged after {step} step(s)")
+            break
+
+    debug(f"The total RMS correction is: {to_db(gain)}")
+    return gain
+
 
-    return rms_coefficient, array_main, array_additional
+def __get_pieces(array: np.ndarray, piece_size: int, idxs) -> np.ndarray:
+    for idx in idxs:
+        yield array[idx * piece_size : (idx + 1) * piece_size]
 
 
 def analyze_levels(
     array: np.ndarray, name: str, config: Config
-) -> (np.ndarray, np.ndarray, np.ndarray, np.ndarray, float, float, float):
+) -> (np.ndarray, np.ndarray, float, int, int):
+    # Works piece by piece on the stereo array, so neither the full mid and side channels
+    # nor their copies are ever allocated. Only the loudest pieces are returned
     name = name.upper()
-    debug(f"Calculating mid and side channels of the {name}...")
-    mid, side = lr_to_ms(array)
-    del array
-
     array_size, divisions, piece_size = __calculate_piece_sizes(
-        mid, config.max_piece_size, name, config.internal_sample_rate
+        array, config.max_piece_size, name, config.internal_sample_rate
     )
 
-    unfolded_mid, rmses, average_rms = get_average_rms(mid, piece_size, divisions, name)
-    unfolded_side = unfold(side, piece_size, divisions)
+    debug(f"Calculating RMSes of the {name} pieces...")
+    rmses = np.array(
+        [
+            rms(lr_to_mid(piece))
+            for piece in __get_pieces(array, piece_size, range(divisions))
+        ]
+    )
+    average_rms = rms(rmses)
 
-    mid_loudest_pieces, side_loudest_pieces, match_rms = __extract_loudest_pieces(
-        rmses, average_rms, unfolded_mid, unfolded_side, name
+    debug(
+        f"Extracting the loudest pieces of the {name} audio "
+        f"with the RMS value more than average {to_db(average_rms)}..."
     )
+    loudest_piece_idxs, match_rms = get_lpis_and_match_rms(rmses, average_rms)
+
+    debug(f"Calculating mid and side channels of the loudest {name} pieces...")
+    shape = (len(loudest_piece_idxs[0]), piece_size)
+    mid_loudest_pieces = np.empty(shape, dtype=array.dtype)
+    side_loudest_pieces = np.empty(shape, dtype=array.dtype)
+    for idx, piece in enumerate(__get_pieces(array, piece_size, loudest_piece_idxs[0])):
+        mid_loudest_pieces[idx], side_loudest_pieces[idx] = lr_to_ms(piece)
 
     return (
-        mid,
-        side,
         mid_loudest_pieces,
         side_loudest_pieces,
         match_rms,
@@ -21,31 +21,81 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 import numpy as np
 from .log import Code, info, debug, debug_line
 from . import Config
+from .profiles import ReferenceProfile, TargetProfile
 from .utils import to_db
-from .dsp import amplify, normalize, clip
+from .dsp import amplify, normalize, lr_to_ms
 from .stage_helpers import (
     normalize_reference,
     analyze_levels,
+    get_average_fft,
     get_fir,
     convolve,
-    get_average_rms,
-    get_lpis_and_match_rms,
-    get_rms_c_and_amplify_pair,
+    calculate_rms_coefficient,
+    get_rms_correction_gain,
 )
 from .limiter import limit
 
 
+def create_reference_profile(
+    reference: np.ndarray, config: Config
+) -> ReferenceProfile:
+    reference, final_amplitude_coefficient = normalize_reference(reference, config)
+
+    (
+        reference_mid_loudest_pieces,
+        reference_side_loudest_pieces,
+        reference_match_rms,
+        *_,
+    ) = analyze_levels(reference, "reference", config)
+
+    del reference
+
+    debug("Calculating the average spectra of the loudest REFERENCE pieces...")
+    return ReferenceProfile(
+        match_rms=reference_match_rms,
+        final_amplitude_coefficient=final_amplitude_coefficient,
+        mid_fft=get_average_fft(reference_mid_loudest_pieces, config),
+        side_fft=get_average_fft(reference_side_loudest_pieces, config),
+        sample_rate=config.internal_sample_rate,
+        fft_size=config.fft_size,
+        max_piece_size=config.max_piece_size,
+        threshold=config.threshold,
+    )
+
+
+def create_target_profile(target: np.ndarray, config: Config) -> TargetProfile:
+    (
+        target_mid_loudest_pieces,
+        target_side_loudest_pieces,
+        target_match_rms,
+        target_divisions,
+        target_piece_size,
+    ) = analyze_levels(target, "target", config)
+
+    debug("Calculating the average spectra of the loudest TARGET pieces...")
+    return TargetProfile(
+        array=target,
+        match_rms=target_match_rms,
+        divisions=target_divisions,
+        piece_size=target_piece_size,
+        mid_fft=get_average_fft(target_mid_loudest_pieces, config),
+        side_fft=get_average_fft(target_side_loudest_pieces, config),
+        sample_rate=config.internal_sample_rate,
+        fft_size=config.fft_size,
+        max_piece_size=config.max_piece_size,
+    )
+
+
 def __match_levels(
-    target: np.ndarray, reference: np.ndarray, config: Config
+    target, reference, config: Config
 ) -> (
     np.ndarray,
     np.ndarray,
-    float,
-    np.ndarray,
     np.ndarray,
     np.ndarray,
-    np.ndarray,
-    float,
+    int,
+    int,
+    ReferenceProfile,
     float,
 ):
     debug_line()
@@ -56,81 +106,63 @@ def __match_levels(
         f"or {config.max_piece_size / config.internal_sample_rate:.2f} seconds"
     )
 
-    reference, final_amplitude_coefficient = normalize_reference(reference, config)
+    if not isinstance(reference, ReferenceProfile):
+        reference = create_reference_profile(reference, config)
 
-    (
-        target_mid,
-        target_side,
-        target_mid_loudest_pieces,
-        target_side_loudest_pieces,
-        target_match_rms,
-        target_divisions,
-        target_piece_size,
-    ) = analyze_levels(target, "target", config)
+    if not isinstance(target, TargetProfile):
+        target = create_target_profile(target, config)
 
-    (
-        reference_mid,
-        reference_side,
-        reference_mid_loudest_pieces,
-        reference_side_loudest_pieces,
-        reference_match_rms,
-        *_,
-    ) = analyze_levels(reference, "reference", config)
+    # Only the audio itself is needed for the convolution
+    debug("Calculating mid and side channels of the TARGET...")
+    target_mid, target_side = lr_to_ms(target.array)
 
-    rms_coefficient, target_mid, target_side = get_rms_c_and_amplify_pair(
-        target_mid,
-        target_side,
-        target_match_rms,
-        reference_match_rms,
-        config.min_value,
-        "target",
+    # The convolution is linear, so the TARGET is amplified through the FIRs instead of in place
+    rms_coefficient = calculate_rms_coefficient(
+        target.match_rms, reference.match_rms, config.min_value
     )
 
-    debug("Modifying the amplitudes of the extracted loudest TARGET pieces...")
-    target_mid_loudest_pieces = amplify(target_mid_loudest_pieces, rms_coefficient)
-    target_side_loudest_pieces = amplify(target_side_loudest_pieces, rms_coefficient)
+    # The spectrum magnitude is linear in amplitude, so there is no need to amplify the pieces themselves
+    debug("Modifying the average spectra of the loudest TARGET pieces...")
+    target_mid_fft = amplify(target.mid_fft, rms_coefficient)
+    target_side_fft = amplify(target.side_fft, rms_coefficient)
 
     return (
         target_mid,
         target_side,
-        final_amplitude_coefficient,
-        target_mid_loudest_pieces,
-        target_side_loudest_pieces,
-        reference_mid_loudest_pieces,
-        reference_side_loudest_pieces,
-        target_divisions,
-        target_piece_size,
-        reference_match_rms,
+        target_mid_fft,
+        target_side_fft,
+        target.divisions,
+        target.piece_size,
+        reference,
+        rms_coefficient,
     )
 
 
 def __match_frequencies(
     target_mid: np.ndarray,
     target_side: np.ndarray,
-    target_mid_loudest_pieces: np.ndarray,
-    reference_mid_loudest_pieces: np.ndarray,
-    target_side_loudest_pieces: np.ndarray,
-    reference_side_loudest_pieces: np.ndarray,
+    target_mid_fft: np.ndarray,
+    target_side_fft: np.ndarray,
+    reference: ReferenceProfile,
+    gain: float,
     config: Config,
 ) -> (np.ndarray, np.ndarray):
     debug_line()
     info(Code.INFO_MATCHING_FREQS)
 
-    mid_fir = get_fir(
-        target_mid_loudest_pieces, reference_mid_loudest_pieces, "mid", config
+    debug("Applying the RMS coefficient of the TARGET to the FIRs...")
+    mid_fir = amplify(
+        get_fir(target_mid_fft, reference.mid_fft, "mid", config), gain, inplace=True
     )
-    side_fir = get_fir(
-        target_side_loudest_pieces, reference_side_loudest_pieces, "side", config
+    side_fir = amplify(
+        get_fir(target_side_fft, reference.side_fft, "side", config), gain, inplace=True
     )
 
-    del (
-        target_mid_loudest_pieces,
-        reference_mid_loudest_pieces,
-        target_side_loudest_pieces,
-        reference_side_loudest_pieces,
-    )
+    del target_mid_fft, target_side_fft
 
-    result, result_mid = convolve(target_mid, mid_fir, target_side, side_fir)
+    result, result_mid = convolve(
+        target_mid, mid_fir, target_side, side_fir, config.convolution_block_size
+    )
 
     return result, result_mid
 
@@ -146,38 +178,28 @@ def __correct_levels(
     debug_line()
     info(Code.INFO_CORRECTING_LEVELS)
 
-    for step in range(1, config.rms_correction_steps + 1):
-        debug(f"Applying RMS correction #{step}...")
-        result_mid_clipped = clip(result_mid)
-
-        _, clipped_rmses, clipped_average_rms = get_average_rms(
-            result_mid_clipped, target_piece_size, target_divisions, "result"
-        )
-
-        _, result_mid_clipped_match_rms = get_lpis_and_match_rms(
-            clipped_rmses, clipped_average_rms
-        )
+    rms_coefficient = get_rms_correction_gain(
+        result_mid,
+        target_piece_size,
+        target_divisions,
+        reference_match_rms,
+        config,
+    )
 
-        rms_coefficient, result_mid, result = get_rms_c_and_amplify_pair(
-            result_mid,
-            result,
-            result_mid_clipped_match_rms,
-            reference_match_rms,
-            config.min_value,
-            "result",
-        )
+    debug("Modifying the amplitudes of the RESULT audio...")
+    result = amplify(result, rms_coefficient, inplace=True)
 
     return result
 
 
-def __finalize(
+def finalize(
     result_no_limiter: np.ndarray,
     final_amplitude_coefficient: float,
-    need_default: bool,
+    limiter_configs: list,
     need_no_limiter: bool,
     need_no_limiter_normalized: bool,
     config: Config,
-) -> (np.ndarray, np.ndarray, np.ndarray):
+) -> (list, np.ndarray, np.ndarray):
     debug_line()
     info(Code.INFO_FINALIZING)
 
@@ -188,6 +210,8 @@ def __finalize(
             config.threshold,
             config.min_value,
             normalize_clipped=True,
+            # Nothing else needs the pre-limiter result
+            inplace=not limiter_configs and not need_no_limiter,
         )
         debug(
             f"The amplitude of the normalized RESULT should be adjusted by {to_db(coefficient)}"
@@ -197,76 +221,99 @@ def __finalize(
                 f"And by {to_db(final_amplitude_coefficient)} after applying some brickwall limiter to it"
             )
 
-    result = None
-    if need_default:
-        result = limit(result_no_limiter, config)
-        result = amplify(result, final_amplitude_coefficient)
+    # Every limiter config gets its own pass over the same pre-limiter result
+    results = []
+    for limiter_config in limiter_configs:
+        if len(limiter_configs) > 1:
+            debug(
+                f"Limiting the RESULT variant #{len(results) + 1} "
+                f"with the threshold of {to_db(limiter_config.threshold)}..."
+            )
+        if limiter_config.post_limiter_ceiling is None:
+            # The final amplitude coefficient is folded into the gain envelope of the limiter
+            result = limit(result_no_limiter, limiter_config, final_amplitude_coefficient)
+        else:
+            result = limit(result_no_limiter, limiter_config)
+            # The peak normalization makes the final amplitude coefficient redundant,
+            # so the ceiling is reached with a single gain
+            result, coefficient = normalize(
+                result,
+                limiter_config.post_limiter_ceiling,
+                config.min_value,
+                normalize_clipped=True,
+                inplace=True,
+            )
+            debug(
+                f"The limited RESULT is normalized to the ceiling of "
+                f"{to_db(limiter_config.post_limiter_ceiling)} with {to_db(1 / coefficient)}"
+            )
+        results.append(result)
 
     result_no_limiter = result_no_limiter if need_no_limiter else None
 
-    return result, result_no_limiter, result_no_limiter_normalized
+    return results, result_no_limiter, result_no_limiter_normalized
 
 
-def main(
-    target: np.ndarray,
-    reference: np.ndarray,
-    config: Config,
-    need_default: bool = True,
-    need_no_limiter: bool = False,
-    need_no_limiter_normalized: bool = False,
-) -> (np.ndarray, np.ndarray, np.ndarray):
+def match(target, reference, config: Config) -> (np.ndarray, float):
+    # The target and the reference can be either audio arrays or precomputed profiles
     (
         target_mid,
         target_side,
-        final_amplitude_coefficient,
-        target_mid_loudest_pieces,
-        target_side_loudest_pieces,
-        reference_mid_loudest_pieces,
-        reference_side_loudest_pieces,
+        target_mid_fft,
+        target_side_fft,
         target_divisions,
         target_piece_size,
-        reference_match_rms,
+        reference,
+        target_rms_coefficient,
     ) = __match_levels(target, reference, config)
 
-    del target, reference
+    del target
 
     result_no_limiter, result_no_limiter_mid = __match_frequencies(
         target_mid,
         target_side,
-        target_mid_loudest_pieces,
-        reference_mid_loudest_pieces,
-        target_side_loudest_pieces,
-        reference_side_loudest_pieces,
+        target_mid_fft,
+        target_side_fft,
+        reference,
+        target_rms_coefficient,
         config,
     )
 
-    del (
-        target_mid,
-        target_side,
-        target_mid_loudest_pieces,
-        reference_mid_loudest_pieces,
-        target_side_loudest_pieces,
-        reference_side_loudest_pieces,
-    )
+    del target_mid, target_side
 
     result_no_limiter = __correct_levels(
         result_no_limiter,
         result_no_limiter_mid,
         target_divisions,
         target_piece_size,
-        reference_match_rms,
+        reference.match_rms,
         config,
     )
 
-    del result_no_limiter_mid
+    return result_no_limiter, reference.final_amplitude_coefficient
+
+
+def main(
+    target: np.ndarray,
+    reference,
+    config: Config,
+    need_default: bool = True,
+    need_no_limiter: bool = False,
+    need_no_limiter_normalized: bool = False,
+) -> (np.ndarray, np.ndarray, np.ndarray):
+    result_no_limiter, final_amplitude_coefficient = match(target, reference, config)
+
+    del target, reference
 
-    result, result_no_limiter, result_no_limiter_normalized = __finalize(
+    results, result_no_limiter, result_no_limiter_normalized = finalize(
         result_no_limiter,
         final_amplitude_coefficient,
-        need_default,
+        [config] if need_default else [],
         need_no_limiter,
         need_no_limiter_normalized,
         config,
     )
 
+    result = results[0] if results else None
+
     return result, result_no_limiter, result_no_limiter_normalized
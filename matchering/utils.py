@@ -22,12 +22,16 @@ import os
 import random
 import string
 import math
+import tempfile
 from datetime import timedelta
 
 
 def get_temp_folder(results: list) -> str:
-    first_result_file = results[0].file
-    return os.path.dirname(os.path.abspath(first_result_file))
+    for result in results:
+        if isinstance(result.file, (str, os.PathLike)):
+            return os.path.dirname(os.path.abspath(result.file))
+    # All the results are written to file objects
+    return tempfile.gettempdir()
 
 
 def random_str(size: int = 16) -> str:
@@ -15,6 +15,10 @@ setup(
     long_description=long_description,
     long_description_content_type="text/markdown",
     install_requires=requirements,
+    extras_require={
+        "statsmodels": ["statsmodels>=0.13.2"],
+        "resampy": ["resampy>=0.4.2"],
+    },
     license="GPLv3",
     url="https://github.com/sergree/matchering",
     packages=find_packages(include=["matchering", "matchering.*"]),